@@ -0,0 +1,142 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import mimetypes
+import threading
+from types import SimpleNamespace
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+# ! =============== MODEL BACKENDS ===============
+
+# a backend is anything with a `model_name`, a `generate_content(contents, generation_config=None)`
+# returning an object with a `.text` and an `upload_file(path)` returning a File API handle
+
+GEMINI_MODEL_NAME = 'models/gemini-1.5-flash-8b'
+
+class GeminiBackend:
+    """Google Gemini through the google.generativeai SDK."""
+    def __init__(self, model_name=GEMINI_MODEL_NAME, api_key=None):
+        genai.configure(api_key=api_key or os.getenv("GEMINI_API_KEY"))
+        self.model = genai.GenerativeModel(model_name)
+        self.model_name = self.model.model_name
+
+    def generate_content(self, contents, generation_config=None):
+        return self.model.generate_content(contents, generation_config=generation_config)
+
+    def upload_file(self, path):
+        return genai.upload_file(path=path)
+
+FAKE_SUBJECTS = ['History', 'Chemistry', 'Geography', 'Physics', 'Biology', 'Sociology', 'Philosophy', 'Mathematics', 'Art History']
+FAKE_IMAGE_TYPES = ['graph', 'table', 'diagram', 'scientific formula', 'text', 'figure', 'map', 'photo']
+FAKE_IMPORTANCES = ['essential', 'useful']
+
+class FakeBackend:
+    """
+    Local stand-in for Gemini used to benchmark and test the pipeline without an API key.
+    Each call sleeps `latency` seconds and fails with a retryable ServiceUnavailable with
+    probability `error_rate`. Answers follow the prompt formats and are derived from a hash
+    of the prompt (so they are stable between runs), unless a canned answer is given in
+    `responses` for 'subject', 'subject_batch' or 'image'.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, responses=None, seed=0):
+        self.model_name = 'fake'
+        self.latency = latency
+        self.error_rate = error_rate
+        self.responses = responses or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.uploads = 0
+
+    def simulate_request(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+        if failed:
+            raise google_exceptions.ServiceUnavailable('Fake backend error')
+
+    def generate_content(self, contents, generation_config=None):
+        with self.lock:
+            self.calls += 1
+        self.simulate_request()
+        text = contents[0] if isinstance(contents, list) else contents
+        digest = int(hashlib.sha256(text.encode('utf-8')).hexdigest(), 16)
+        if isinstance(contents, list):
+            answer = self.responses.get('image') or (
+                f"Category:\n{FAKE_IMAGE_TYPES[digest % len(FAKE_IMAGE_TYPES)]}\n\n"
+                f"Importance:\n{FAKE_IMPORTANCES[digest % len(FAKE_IMPORTANCES)]}"
+            )
+        elif generation_config is not None:
+            count = int(re.search(r'receive (\d+) numbered questions', text).group(1))
+            answer = self.responses.get('subject_batch') or json.dumps([
+                {'question': number, 'subject': FAKE_SUBJECTS[(digest + number) % len(FAKE_SUBJECTS)]}
+                for number in range(1, count + 1)
+            ])
+        else:
+            answer = self.responses.get('subject') or f"Subject:\n{FAKE_SUBJECTS[digest % len(FAKE_SUBJECTS)]}"
+        # rough token counts (4 characters per token) so run reports have usage to show
+        usage = SimpleNamespace(prompt_token_count=len(text) // 4, candidates_token_count=len(answer) // 4)
+        usage.total_token_count = usage.prompt_token_count + usage.candidates_token_count
+        return SimpleNamespace(text=answer, usage_metadata=usage)
+
+    def upload_file(self, path):
+        with self.lock:
+            self.uploads += 1
+        self.simulate_request()
+        return SimpleNamespace(
+            name=f'files/fake-{os.path.basename(path)}',
+            uri=f'fake://{os.path.abspath(path)}',
+            mime_type=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            expiration_time=None,
+        )
+
+class InstrumentedBackend:
+    """
+    Wraps a backend recording, in a metrics.RunMetrics, the latency, errors and token usage
+    (response.usage_metadata) of every request and upload.
+    """
+    def __init__(self, backend, metrics):
+        self.backend = backend
+        self.metrics = metrics
+        self.model_name = backend.model_name
+
+    def generate_content(self, contents, generation_config=None):
+        if isinstance(contents, list):
+            kind = 'image'
+        else:
+            kind = 'subject_batch' if generation_config is not None else 'subject'
+        start_time = time.perf_counter()
+        try:
+            response = self.backend.generate_content(contents, generation_config=generation_config)
+        except Exception as error:
+            self.metrics.record_call(kind, time.perf_counter() - start_time, error=error)
+            raise
+        self.metrics.record_call(kind, time.perf_counter() - start_time, usage=getattr(response, 'usage_metadata', None))
+        return response
+
+    def upload_file(self, path):
+        start_time = time.perf_counter()
+        try:
+            remote_file = self.backend.upload_file(path=path)
+        except Exception as error:
+            self.metrics.record_call('upload', time.perf_counter() - start_time, error=error)
+            raise
+        self.metrics.record_call('upload', time.perf_counter() - start_time)
+        return remote_file
+
+def make_backend(name='gemini', fake_latency=0.0, fake_error_rate=0.0, fake_responses=None):
+    """Builds the backend selected with --backend, `fake_responses` is the path of a JSON file with canned answers."""
+    if name == 'gemini':
+        return GeminiBackend()
+    if name == 'fake':
+        responses = None
+        if fake_responses:
+            with open(fake_responses, 'r') as responses_file:
+                responses = json.load(responses_file)
+        return FakeBackend(fake_latency, fake_error_rate, responses)
+    raise ValueError(f"Unknown backend {name!r}, use 'gemini' or 'fake'")
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from PIL import Image
+from utils import *
+from backends import FakeBackend
+from cache import UploadRegistry
+from dataset import merge_json_files, find_parallel_questions
+from dedup import ParallelQuestionIndex
+from validation import validate_exam
+from process_data import parse_prova, run_classification_jobs
+
+# ! =============== REFERENCE IMPLEMENTATIONS ===============
+
+def legacy_split_exam(document):
+    """Prefilter + QUESTÃO normalization as it was done before TextNormalizer (one pass per substitution)."""
+    text = remove_font_markers(document)
+    text = remove_section_tags(text)
+    text = fix_itemize(text)
+    text = fix_enumerate(text)
+    text = fix_center(text)
+    text = remove_latex_breaklines(text)
+    text = fix_hyphen(text)
+    sample_prova = fix_ordinals(text)
+    isolated_questions = sample_prova.replace('QUESTAO', 'QUESTÃO')\
+        .replace('QUESTATO', 'QUESTÃO')\
+        .replace('QUESTȦO', 'QUESTÃO')\
+        .replace('QUESTÃ0', 'QUESTÃO')\
+        .replace('QUESTĀO', 'QUESTÃO')\
+        .replace('Questāo', 'QUESTÃO')\
+        .replace('Questão', 'QUESTÃO')\
+        .split('QUESTÃO')[1:]
+    potetial_support_text = sample_prova.replace('QUESTAO', 'QUESTÃO')\
+        .replace('QUESTATO', 'QUESTÃO')\
+        .replace('QUESTȦO', 'QUESTÃO')\
+        .replace('QUESTÃ0', 'QUESTÃO')\
+        .replace('QUESTĀO', 'QUESTÃO')\
+        .replace('Questāo', 'QUESTÃO')\
+        .replace('Questão', 'QUESTÃO')\
+        .split('QUESTÃO')[:1][0]
+    return potetial_support_text, isolated_questions
+
+def legacy_segment_exam(document):
+    """Stems and alternatives obtained by splitting the question strings, as parse_prova did before ExamSegments."""
+    _, isolated_questions = split_exam(document)
+    segments = []
+    for question in remove_question_number_line(isolated_questions):
+        segments.append((question.split('(A)')[0].strip(), extract_alternatives_content(question)))
+    return segments
+
+def offset_segment_exam(document):
+    exam = ExamSegments(document)
+    return [(exam.text(question.start, question.stem_end).strip(), exam.alternatives(question)) for question in exam.questions]
+
+# ! =============== BENCHMARKS ===============
+
+def best_time(fn, *args, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+def load_exam_bodies(prova_dir):
+    bodies = []
+    for year in sorted(os.listdir(prova_dir)):
+        prova_path = os.path.join(prova_dir, year, 'prova.tex')
+        if os.path.exists(prova_path):
+            with open(prova_path, 'r') as prova_file:
+                bodies.append(prova_file.read().split('\\begin{document}')[-1].replace('\n\n\n\\end{document}', ''))
+    return bodies
+
+def benchmark_prefilter(prova_dir, copies=10, repeat=5):
+    """Times the legacy substitution chain against split_exam on all exams of `prova_dir` concatenated `copies` times."""
+    document = ''.join(load_exam_bodies(prova_dir)) * copies
+    legacy_time = best_time(legacy_split_exam, document, repeat=repeat)
+    fused_time = best_time(split_exam, document, repeat=repeat)
+    same_output = legacy_split_exam(document) == split_exam(document)
+    print(f"Document size: {len(document) / 1e6:.2f}M characters")
+    print(f"  legacy chain: {legacy_time * 1000:.1f}ms ({len(document) / legacy_time / 1e6:.1f}M chars/s)")
+    print(f"  split_exam:   {fused_time * 1000:.1f}ms ({len(document) / fused_time / 1e6:.1f}M chars/s)")
+    print(f"  speedup: {legacy_time / fused_time:.2f}x, same output: {same_output}")
+    return {'characters': len(document), 'legacy_seconds': legacy_time, 'fused_seconds': fused_time, 'same_output': same_output}
+
+def benchmark_segmentation(prova_dir, copies=10, repeat=5):
+    """Times string splitting against ExamSegments on the same concatenated document as benchmark_prefilter."""
+    document = ''.join(load_exam_bodies(prova_dir)) * copies
+    legacy_time = best_time(legacy_segment_exam, document, repeat=repeat)
+    offset_time = best_time(offset_segment_exam, document, repeat=repeat)
+    print(f"  legacy segmentation: {legacy_time * 1000:.1f}ms")
+    print(f"  ExamSegments:        {offset_time * 1000:.1f}ms")
+    print(f"  speedup: {legacy_time / offset_time:.2f}x")
+    return {'legacy_seconds': legacy_time, 'offset_seconds': offset_time}
+
+# ! =============== SYNTHETIC EXAMS ===============
+
+def make_synthetic_exam(year_path, year, images=True, seed=0):
+    """
+    Writes a 90-question prova.tex/gabarito.tex pair in the Mathpix format the pipeline expects,
+    with the usual noise (OCR'd question markers, sections, itemize, ordinals, [0pt]), one shared
+    support text and, with `images`, an image every 5 questions (PNG and JPG sources).
+    """
+    rng = random.Random(f'{seed}-{year}')
+    images_dir = os.path.join(year_path, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    parts = ['\\documentclass{article}\n\\begin{document}\nVestibular\n\n']
+    for number in range(1, 91):
+        marker = QUESTION_MARKER_VARIANTS[number % len(QUESTION_MARKER_VARIANTS)] if number % 7 == 0 else 'QUESTÃO'
+        body = (f"{marker} {number:02d}\n\\section*{{Enunciado {number}}}\n"
+                f"Texto da questão {number} sobre o 1o tema -- com \\begin{{itemize}}\n  \\item item um[0pt]\n\\end{{itemize}}\\\\\n"
+                f"{' '.join(rng.choice(['prova', 'texto', 'imagem', 'resposta', 'questão', 'análise']) for _ in range(60))}?\n")
+        if images and number % 5 == 0:
+            # Mathpix names the 2025 crops .jpg, see source_image_filename
+            name = f"2025_01_24_img{number}" if number % 10 == 0 else f"2024_01_24_img{number}"
+            image = Image.linear_gradient('L').resize((1200 + number, 900)).convert('RGB')
+            image.save(os.path.join(images_dir, f"{name}.jpg" if number % 10 == 0 else f"{name}.png"))
+            body += f"\\begin{{center}}\n\\includegraphics[max width=\\textwidth]{{{name}}}\n\\end{{center}}\n"
+        body += ''.join(f"({letter}) alternativa {letter} da questão {number}\n" for letter in ALTERNATIVE_DICT)
+        if number == 30:
+            body += "\nLeia o texto para responder às questões 31 e 32.\n\nTexto de apoio compartilhado.\n"
+        parts.append(body + '\n')
+    parts.append('\n\n\n\\end{document}')
+    with open(os.path.join(year_path, 'prova.tex'), 'w') as prova_file:
+        prova_file.write(''.join(parts))
+    cells = [f"${number}-\\mathrm{{{'ABCDE'[number % 5]}}}$" for number in range(1, 91)]
+    rows = [' & '.join(cells[start:start+6]) + ' \\\\\n\\hline' for start in range(0, 90, 6)]
+    with open(os.path.join(year_path, 'gabarito.tex'), 'w') as gabarito_file:
+        gabarito_file.write('\\begin{tabular}{|c|c|c|c|c|c|}\n\\hline\n' + '\n'.join(rows) + '\n\\end{tabular}')
+
+def make_synthetic_tree(prova_dir, years, images=True, seed=0):
+    """Synthetic exams for the first `years` years of SOURCE_DICT (the only years parse_prova accepts)."""
+    shutil.rmtree(prova_dir, ignore_errors=True)
+    for year in sorted(SOURCE_DICT)[:years]:
+        make_synthetic_exam(os.path.join(prova_dir, str(year)), year, images, seed)
+
+# ! =============== PIPELINE BENCHMARK ===============
+
+def timed(fn):
+    start_time = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start_time
+
+def stage_stats(seconds, items, unit):
+    return {'seconds': seconds, 'items': items, 'unit': unit, 'throughput': items / seconds if seconds else 0.0}
+
+def benchmark_pipeline(work_dir, years=4, images=True, latency=0.02, error_rate=0.0, concurrency=8, image_workers=4,
+                       subject_batch_size=1, seed=0):
+    """
+    Runs every stage of the pipeline on a synthetic tree with the fake backend and returns
+    {stage: stats} with the time and throughput of the prefilter, segmentation (which also
+    normalizes), validation, image staging + preprocessing, classification requests, the
+    whole parse_prova (with the images already staged) and the merge.
+    """
+    prova_dir = 'SYNTH'
+    previous_dir = os.getcwd()
+    os.makedirs(work_dir, exist_ok=True)
+    # parse_prova builds the image paths relative to the working directory
+    os.chdir(work_dir)
+    try:
+        make_synthetic_tree(prova_dir, years, images, seed)
+        exam_years = list_exam_years(prova_dir)
+        texts, gabaritos = {}, {}
+        for year in exam_years:
+            with open(os.path.join(prova_dir, year, 'prova.tex'), 'r') as prova_file:
+                texts[year] = prova_file.read()
+            with open(os.path.join(prova_dir, year, 'gabarito.tex'), 'r') as gabarito_file:
+                gabaritos[year] = parse_gabarito(gabarito_file.read())
+        bodies = {year: exam_body(texts[year]) for year in exam_years}
+        characters = sum(len(body) for body, _ in bodies.values())
+        questions = 90 * len(exam_years)
+        stages = {}
+
+        _, seconds = timed(lambda: [DOCUMENT_NORMALIZER(body) for body, _ in bodies.values()])
+        stages['prefilter'] = stage_stats(seconds, characters, 'chars')
+        exams, seconds = timed(lambda: {year: ExamSegments(*bodies[year]) for year in exam_years})
+        stages['segmentation'] = stage_stats(seconds, characters, 'chars')
+        _, seconds = timed(lambda: [validate_exam(exams[year], gabaritos[year], int(year)) for year in exam_years])
+        stages['validation'] = stage_stats(seconds, questions, 'questions')
+
+        def stage_images():
+            staged = []
+            for year in exam_years:
+                exam = exams[year]
+                stager = ImageStager(prova_dir, int(year), image_workers)
+                for idx, question in enumerate(exam.questions):
+                    directive = exam.first_includegraphics(question.start, question.stem_end)
+                    if directive:
+                        filename = stager.stage(source_image_filename(directive), question.number)
+                        staged.append((year, idx, f"./{prova_dir}/{year}/new_images/{filename}"))
+                stager.wait()
+                stager.close()
+            ImagePreprocessor().prepare_all([path for _, _, path in staged], image_workers)
+            return staged
+        staged, seconds = timed(stage_images)
+        stages['images'] = stage_stats(seconds, len(staged), 'images')
+
+        def classify():
+            requests = 0
+            for year in exam_years:
+                exam = exams[year]
+                backend = FakeBackend(latency, error_rate, seed=seed)
+                uploads = UploadRegistry(':memory:', backend.upload_file)
+                prova = [{'question': exam.text(question.start, question.stem_end).strip()} for question in exam.questions]
+                jobs = [('subject', idx, (questao['question'],)) for idx, questao in enumerate(prova)]
+                jobs += [('image', idx, (path, prova[idx]['question'], None)) for image_year, idx, path in staged if image_year == year]
+                run_classification_jobs(backend, prova, jobs, concurrency, uploads=uploads, subject_batch_size=subject_batch_size)
+                uploads.close()
+                requests += len(jobs)
+            return requests
+        requests, seconds = timed(classify)
+        stages['classification'] = stage_stats(seconds, requests, 'requests')
+
+        def parse_all():
+            for year in exam_years:
+                prova = parse_prova(prova_dir, texts[year], int(year), gabaritos[year], concurrency,
+                                    subject_batch_size=subject_batch_size, image_workers=image_workers,
+                                    preprocessor=ImagePreprocessor(), model=FakeBackend(latency, error_rate, seed=seed))
+                save_list_of_dicts_to_json(prova, os.path.join(prova_dir, year, 'prova.json'))
+        _, seconds = timed(parse_all)
+        stages['parse_prova'] = stage_stats(seconds, questions, 'questions')
+        _, seconds = timed(lambda: merge_json_files(prova_dir))
+        stages['merge'] = stage_stats(seconds, questions, 'questions')
+        _, seconds = timed(lambda: find_parallel_questions(prova_dir, prova_dir, ParallelQuestionIndex(':memory:')))
+        stages['parallel'] = stage_stats(seconds, questions, 'questions')
+    finally:
+        os.chdir(previous_dir)
+    return stages
+
+def print_stages(stages, baseline=None):
+    for name, stats in stages.items():
+        line = f"  {name:<15} {stats['seconds'] * 1000:9.1f}ms {stats['throughput']:12.1f} {stats['unit']}/s"
+        if baseline and name in baseline['stages'] and baseline['stages'][name]['throughput']:
+            line += f"  ({stats['throughput'] / baseline['stages'][name]['throughput']:.2f}x baseline)"
+        print(line)
+
+def find_regressions(stages, baseline, tolerance=0.25):
+    """Stages whose throughput dropped more than `tolerance` (fraction) below the baseline."""
+    regressions = []
+    for name, stats in stages.items():
+        reference = baseline['stages'].get(name)
+        if reference and stats['items'] and stats['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--prova_dir', help='Diretório em que as provas estão armazenadas seguindo a estrutura de pastas presente no README.')
+parser.add_argument('--copies', type=int, default=10, help='Quantas vezes as provas são concatenadas para formar o documento do benchmark.')
+parser.add_argument('--repeat', type=int, default=5, help='Número de repetições de cada medição (o melhor tempo é reportado).')
+parser.add_argument('--pipeline', action='store_true', help='Executa o benchmark de todas as etapas do pipeline em provas sintéticas, com o backend fake.')
+parser.add_argument('--years', type=int, default=4, help='Número de anos sintéticos gerados para o benchmark do pipeline.')
+parser.add_argument('--no_images', action='store_true', help='Gera as provas sintéticas sem imagens.')
+parser.add_argument('--fake_latency', type=float, default=0.02, help='Latência, em segundos, de cada requisição do backend fake.')
+parser.add_argument('--fake_error_rate', type=float, default=0.0, help='Fração das requisições do backend fake que falham com erro temporário.')
+parser.add_argument('--concurrency', type=int, default=8, help='Número máximo de requisições simultâneas ao backend fake.')
+parser.add_argument('--image_workers', type=int, default=4, help='Número de threads usadas para converter as imagens.')
+parser.add_argument('--subject_batch_size', type=int, default=1, help='Número de questões classificadas por requisição de matéria.')
+parser.add_argument('--work_dir', help='Diretório onde as provas sintéticas são geradas (padrão: diretório temporário apagado ao final).')
+parser.add_argument('--save_baseline', help='Salva os tempos de cada etapa neste arquivo JSON.')
+parser.add_argument('--baseline', help='Arquivo JSON salvo com --save_baseline; o benchmark falha se alguma etapa ficar mais lenta.')
+parser.add_argument('--tolerance', type=float, default=0.25, help='Queda de desempenho tolerada em relação ao baseline (0.25 = 25%%).')
+
+def run_pipeline_benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bemu_benchmark_')
+    try:
+        stages = benchmark_pipeline(work_dir, args.years, not args.no_images, args.fake_latency, args.fake_error_rate,
+                                    args.concurrency, args.image_workers, args.subject_batch_size)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    settings = ['years', 'no_images', 'fake_latency', 'fake_error_rate', 'concurrency', 'image_workers', 'subject_batch_size']
+    if baseline and any(baseline['config'].get(name) != getattr(args, name) for name in settings):
+        print("Warning: benchmark settings differ from the baseline, the comparison is not meaningful")
+    print(f"Pipeline benchmark ({args.years} synthetic year(s), fake latency {args.fake_latency}s):")
+    print_stages(stages, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'config': vars(args), 'stages': stages}, baseline_file, indent=4)
+    if baseline:
+        regressions = find_regressions(stages, baseline, args.tolerance)
+        if regressions:
+            print(f"Regression: {regressions} slower than the baseline by more than {args.tolerance:.0%}")
+            raise SystemExit(1)
+        print("No regressions against the baseline.")
+
+def main() -> None:
+    args = parser.parse_args()
+    if args.pipeline:
+        run_pipeline_benchmark(args)
+        return
+    benchmark_prefilter(args.prova_dir, args.copies, args.repeat)
+    benchmark_segmentation(args.prova_dir, args.copies, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# ! =============== GEMINI RESPONSE CACHE ===============
+
+class ClassificationCache:
+    """
+    Persistent cache of Gemini classifications stored in a SQLite file.
+    Entries are keyed by a hash of the model name, the prompt template, the
+    question text and the image bytes, so only questions whose content changed
+    are sent to the API again.
+    """
+    def __init__(self, path, max_entries=0, max_age_days=0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS classifications (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+        self.evict()
+
+    @staticmethod
+    def make_key(model_name, prompt_template, question_text, image_path=None):
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_template, question_text):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        if image_path:
+            digest.update(file_sha256(image_path).encode('ascii'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT value FROM classifications WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE classifications SET last_used = ? WHERE key = ?', (time.time(), key))
+        return tuple(json.loads(row[0]))
+
+    def put(self, key, kind, value):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO classifications (key, kind, value, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, kind, json.dumps(list(value), ensure_ascii=False), now, now)
+            )
+
+    def evict(self):
+        """Drops entries older than `max_age_days` and, past `max_entries`, the least recently used ones."""
+        with self.lock, self.conn:
+            if self.max_age_days:
+                self.conn.execute('DELETE FROM classifications WHERE created_at < ?', (time.time() - self.max_age_days * 86400,))
+            if self.max_entries:
+                self.conn.execute("""
+                    DELETE FROM classifications WHERE key IN (
+                        SELECT key FROM classifications ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_entries,))
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM classifications').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ! =============== GEMINI UPLOAD REGISTRY ===============
+
+# files uploaded through the Gemini File API are deleted after 48 hours
+UPLOAD_LIFETIME = 48 * 3600
+
+class UploadRegistry:
+    """
+    Remembers which images were already uploaded to the Gemini File API, keyed by
+    the image content hash, so the same bytes are only uploaded again once the
+    remote file expired. Handles are returned as `file_data` parts that can be
+    passed directly to `model.generate_content`.
+    """
+    def __init__(self, path, upload_fn, expiry_margin=3600):
+        self.upload_fn = upload_fn
+        self.expiry_margin = expiry_margin
+        self.reused = 0
+        self.uploaded = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    sha256 TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    uri TEXT NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    def get(self, image_path, content_hash=None):
+        """Returns a valid remote handle for the image, or None if it has to be uploaded."""
+        content_hash = content_hash or file_sha256(image_path)
+        with self.lock:
+            row = self.conn.execute('SELECT uri, mime_type, expires_at FROM uploads WHERE sha256 = ?', (content_hash,)).fetchone()
+        if row is None or row[2] - self.expiry_margin < time.time():
+            return None
+        return {'file_data': {'file_uri': row[0], 'mime_type': row[1]}}
+
+    def upload(self, image_path, content_hash=None):
+        content_hash = content_hash or file_sha256(image_path)
+        handle = self.get(image_path, content_hash)
+        if handle is not None:
+            with self.lock:
+                self.reused += 1
+            return handle
+        remote_file = self.upload_fn(path=image_path)
+        expiration_time = getattr(remote_file, 'expiration_time', None)
+        expires_at = expiration_time.timestamp() if expiration_time else time.time() + UPLOAD_LIFETIME
+        with self.lock, self.conn:
+            self.uploaded += 1
+            self.conn.execute(
+                'INSERT OR REPLACE INTO uploads (sha256, name, uri, mime_type, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (content_hash, remote_file.name, remote_file.uri, remote_file.mime_type, expires_at)
+            )
+        return {'file_data': {'file_uri': remote_file.uri, 'mime_type': remote_file.mime_type}}
+
+    def upload_all(self, image_paths, max_workers=1, retry_fn=None):
+        """
+        Uploads the new/expired images among `image_paths` in parallel and returns
+        {image_path: handle}. Images whose upload failed are left out of the result.
+        """
+        upload = self.upload if retry_fn is None else (lambda *args: retry_fn(self.upload, *args))
+        # identical images under different names are uploaded only once
+        paths_by_hash = {}
+        for path in dict.fromkeys(image_paths):
+            paths_by_hash.setdefault(file_sha256(path), []).append(path)
+        handles = {}
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {executor.submit(upload, paths[0], content_hash): paths for content_hash, paths in paths_by_hash.items()}
+            for future in as_completed(futures):
+                paths = futures[future]
+                try:
+                    handle = future.result()
+                except Exception as error:
+                    print(f"Warning: failed to upload {paths[0]}: {error}")
+                    continue
+                for path in paths:
+                    handles[path] = handle
+        return handles
+
+    def close(self):
+        self.conn.close()
+
+# ! =============== BUILD MANIFEST ===============
+
+class BuildManifest:
+    """
+    JSON file recording, for each exam year, the content hashes of its inputs
+    (prova.tex, gabarito.tex, images, pipeline version and the run settings that
+    change its prova.json) and of the prova.json produced from them, so unchanged
+    years and merges can be skipped.
+    """
+    def __init__(self, path, pipeline_version):
+        self.path = path
+        self.pipeline_version = pipeline_version
+        self.data = {'years': {}, 'merged': None}
+        if os.path.exists(path):
+            with open(path, 'r') as manifest_file:
+                self.data = json.load(manifest_file)
+
+    def year_inputs(self, year_path, settings=None):
+        return {
+            'prova_tex': file_sha256(os.path.join(year_path, 'prova.tex')),
+            'gabarito_tex': file_sha256(os.path.join(year_path, 'gabarito.tex')),
+            'images': directory_sha256(os.path.join(year_path, 'images')),
+            'pipeline_version': self.pipeline_version,
+            'settings': settings,
+        }
+
+    def is_up_to_date(self, year, inputs, output_path):
+        entry = self.data['years'].get(year)
+        return (entry is not None and entry['inputs'] == inputs
+                and os.path.exists(output_path) and file_sha256(output_path) == entry['output'])
+
+    def record_year(self, year, inputs, output_path, images_dir=None):
+        """`images_dir` holds the staged images copied into the merged dataset, so a restaged image also triggers a merge."""
+        self.data['years'][year] = {
+            'inputs': inputs,
+            'output': file_sha256(output_path),
+            'images': directory_sha256(images_dir) if images_dir is not None else None,
+        }
+
+    def outputs(self, years):
+        return {year: [self.data['years'][year]['output'], self.data['years'][year].get('images')]
+                for year in years if year in self.data['years']}
+
+    def needs_merge(self, outputs, merged_path, settings=None):
+        return self.data.get('merged') != {'outputs': outputs, 'settings': settings} or not os.path.exists(merged_path)
+
+    def record_merge(self, outputs, settings=None):
+        self.data['merged'] = {'outputs': outputs, 'settings': settings}
+
+    def save(self):
+        # written to a temporary file first so an interrupted run never leaves a corrupted manifest
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(self.data, manifest_file, indent=4)
+        os.replace(tmp_path, self.path)
+
+def directory_sha256(path):
+    """Hash of the names and contents of every file in `path` (empty directory if it doesn't exist)."""
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            file_path = os.path.join(path, filename)
+            if os.path.isfile(file_path):
+                digest.update(filename.encode('utf-8'))
+                digest.update(file_sha256(file_path).encode('ascii'))
+    return digest.hexdigest()
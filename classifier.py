@@ -0,0 +1,235 @@
+import os
+import json
+import math
+import sqlite3
+import hashlib
+from dedup import normalize_question
+from utils import translate_subject
+
+# ! =============== LOCAL SUBJECT CLASSIFIER ===============
+
+# Naive Bayes counts every word as independent evidence, which makes its posteriors
+# overconfident on long questions, so the likelihood is scaled to this many words
+EVIDENCE_WORDS = 12
+# upper bounds of the confidence buckets of the agreement report
+CONFIDENCE_BUCKETS = [0.5, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0]
+# file of each year listing the questions whose subject came from this classifier, they are never used for training
+LOCAL_SUBJECTS_FILE = 'local_subjects.json'
+
+def subject_words(questao):
+    return [word for word in normalize_question(questao).split() if len(word) > 2 and not word.isdigit()]
+
+def confidence_bucket(confidence):
+    return next(f'<={bound}' for bound in CONFIDENCE_BUCKETS if confidence <= bound)
+
+def load_local_subjects(year_path):
+    path = os.path.join(year_path, LOCAL_SUBJECTS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as local_file:
+        return json.load(local_file)
+
+def save_local_subjects(year_path, question_numbers):
+    path = os.path.join(year_path, LOCAL_SUBJECTS_FILE)
+    if not question_numbers:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as local_file:
+        json.dump(sorted(question_numbers), local_file)
+
+def year_blocks(data_dir):
+    """(exam/year, question lines) of a merged dataset, one year in memory at a time (shards hold the years in order)."""
+    year_key, lines = None, []
+    shard_file, shard_name = None, None
+    try:
+        with open(os.path.join(data_dir, 'index.jsonl'), 'r') as index_file:
+            for line in index_file:
+                entry = json.loads(line)
+                if f"{entry['exam']}/{entry['year']}" != year_key:
+                    if lines:
+                        yield year_key, lines
+                    year_key, lines = f"{entry['exam']}/{entry['year']}", []
+                if entry['shard'] != shard_name:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shard_name = entry['shard']
+                    shard_file = open(os.path.join(data_dir, shard_name), 'rb')
+                shard_file.seek(entry['offset'])
+                lines.append(shard_file.read(entry['length']))
+        if lines:
+            yield year_key, lines
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+class SubjectClassifier:
+    """
+    Multinomial Naive Bayes over the words of the question and its options, trained on the
+    subjects Gemini gave in the merged dataset. Word counts are kept per exam year in a SQLite
+    file, so retraining only recounts the years whose questions changed. Questions predicted
+    with a confidence of at least `threshold` are labeled locally, and a deterministic
+    `audit_rate` fraction of them is still sent to Gemini to measure the agreement.
+    """
+    def __init__(self, path, threshold=0.95, audit_rate=0.05, smoothing=0.1):
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.smoothing = smoothing
+        self.labels = []
+        self.priors = []
+        self.word_scores = {}
+        self.stats = {'local': 0, 'escalated': 0, 'audited': 0, 'checked': 0, 'agreed': 0, 'buckets': {}}
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS years (year_key TEXT PRIMARY KEY, digest TEXT NOT NULL)')
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS word_counts (
+                    year_key TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    word TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (year_key, label, word)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS label_counts (
+                    year_key TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (year_key, label)
+                )
+            """)
+        self.load()
+
+    def train(self, prova_dir):
+        """
+        Updates the counts with the merged dataset of `prova_dir` (its data/ shards and index),
+        recounting only the years whose questions or locally labeled questions changed.
+        Returns how many years were recounted.
+        """
+        data_dir = os.path.join(prova_dir, 'data')
+        if not os.path.exists(os.path.join(data_dir, 'index.jsonl')):
+            return 0
+        exam = os.path.basename(os.path.normpath(prova_dir))
+        seen, retrained = set(), 0
+        with self.conn:
+            for year_key, lines in year_blocks(data_dir):
+                seen.add(year_key)
+                local = set(load_local_subjects(os.path.join(prova_dir, year_key.rsplit('/', 1)[1])))
+                digest = hashlib.sha256(b''.join(lines) + json.dumps(sorted(local)).encode('ascii')).hexdigest()
+                row = self.conn.execute('SELECT digest FROM years WHERE year_key = ?', (year_key,)).fetchone()
+                if row is not None and row[0] == digest:
+                    continue
+                self.count_year(year_key, [json.loads(line) for line in lines], local)
+                self.conn.execute('INSERT OR REPLACE INTO years (year_key, digest) VALUES (?, ?)', (year_key, digest))
+                retrained += 1
+            # years removed from the dataset
+            for (year_key,) in self.conn.execute('SELECT year_key FROM years').fetchall():
+                if year_key.rsplit('/', 1)[0] == exam and year_key not in seen:
+                    self.forget_year(year_key)
+                    retrained += 1
+        self.load()
+        return retrained
+
+    def count_year(self, year_key, questions, local):
+        self.forget_year(year_key)
+        word_counts, label_counts = {}, {}
+        for questao in questions:
+            label = questao['category_en']
+            # only subjects Gemini picked from the list, the fixed Portuguese/English ones are never predicted
+            if questao['original_question_num'] in local or questao['original_question_num'] <= 30 or translate_subject(label) == 'unknown':
+                continue
+            label_counts[label] = label_counts.get(label, 0) + 1
+            for word in subject_words(questao):
+                word_counts[(label, word)] = word_counts.get((label, word), 0) + 1
+        self.conn.executemany('INSERT INTO label_counts (year_key, label, count) VALUES (?, ?, ?)',
+                              [(year_key, label, count) for label, count in label_counts.items()])
+        self.conn.executemany('INSERT INTO word_counts (year_key, label, word, count) VALUES (?, ?, ?, ?)',
+                              [(year_key, label, word, count) for (label, word), count in word_counts.items()])
+
+    def forget_year(self, year_key):
+        self.conn.execute('DELETE FROM word_counts WHERE year_key = ?', (year_key,))
+        self.conn.execute('DELETE FROM label_counts WHERE year_key = ?', (year_key,))
+        self.conn.execute('DELETE FROM years WHERE year_key = ?', (year_key,))
+
+    def load(self):
+        """Builds the per-word log-probability vectors from the counts of every year."""
+        label_counts = dict(self.conn.execute('SELECT label, SUM(count) FROM label_counts GROUP BY label'))
+        self.labels = sorted(label_counts)
+        position = {label: idx for idx, label in enumerate(self.labels)}
+        totals = [0] * len(self.labels)
+        counts = {}
+        for label, word, count in self.conn.execute('SELECT label, word, SUM(count) FROM word_counts GROUP BY label, word'):
+            counts.setdefault(word, [0] * len(self.labels))[position[label]] = count
+            totals[position[label]] += count
+        documents = sum(label_counts.values())
+        self.priors = [math.log(label_counts[label] / documents) for label in self.labels]
+        denominators = [total + self.smoothing * len(counts) for total in totals]
+        self.word_scores = {
+            word: tuple(math.log((count + self.smoothing) / denominator) for count, denominator in zip(word_counts, denominators))
+            for word, word_counts in counts.items()
+        }
+
+    @property
+    def trained(self):
+        return len(self.labels) > 1
+
+    def predict(self, questao):
+        """(subject in English, confidence) of a question, or (None, 0.0) before any training."""
+        if not self.trained:
+            return None, 0.0
+        vectors = [self.word_scores[word] for word in subject_words(questao) if word in self.word_scores]
+        if not vectors:
+            return None, 0.0
+        scale = EVIDENCE_WORDS / max(EVIDENCE_WORDS, len(vectors))
+        scores = [prior + scale * sum(column) for prior, column in zip(self.priors, zip(*vectors))]
+        best = max(scores)
+        weights = [math.exp(score - best) for score in scores]
+        idx = weights.index(1.0)
+        return self.labels[idx], 1.0 / sum(weights)
+
+    def is_audited(self, questao):
+        digest = hashlib.sha256(questao['question'].encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64 < self.audit_rate
+
+    def classify(self, questao):
+        """
+        Subject of a question if it can be labeled locally, otherwise None and the question
+        must be sent to Gemini. Returns the local prediction too, see `record`.
+        """
+        label, confidence = self.predict(questao)
+        if label is not None and confidence >= self.threshold:
+            if not self.is_audited(questao):
+                self.stats['local'] += 1
+                return (translate_subject(label), label), (label, confidence)
+            self.stats['audited'] += 1
+        else:
+            self.stats['escalated'] += 1
+        return None, (label, confidence)
+
+    def record(self, prediction, subject_en):
+        """Compares a local prediction with the subject Gemini gave to the same question."""
+        label, confidence = prediction
+        if label is None or translate_subject(subject_en) == 'unknown':
+            return
+        bucket = self.stats['buckets'].setdefault(confidence_bucket(confidence), {'checked': 0, 'agreed': 0})
+        for entry in (self.stats, bucket):
+            entry['checked'] += 1
+            entry['agreed'] += label == subject_en
+
+    def report(self):
+        return json.loads(json.dumps(self.stats))
+
+    def close(self):
+        self.conn.close()
+
+def combine_subject_reports(reports):
+    totals = {'local': 0, 'escalated': 0, 'audited': 0, 'checked': 0, 'agreed': 0, 'buckets': {}}
+    for report in reports:
+        for key in ('local', 'escalated', 'audited', 'checked', 'agreed'):
+            totals[key] += report[key]
+        for name, bucket in report['buckets'].items():
+            total = totals['buckets'].setdefault(name, {'checked': 0, 'agreed': 0})
+            total['checked'] += bucket['checked']
+            total['agreed'] += bucket['agreed']
+    return totals
@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import filecmp
+from utils import link_or_copy
+from dedup import ParallelQuestionIndex, question_order
+
+# ! =============== MERGED DATASET ===============
+
+class ShardWriter:
+    """
+    Writes questions as JSON lines into numbered shards of at most `shard_size`
+    questions and records, for each one, the shard and byte range it was written to.
+    """
+    def __init__(self, data_dir, shard_size=1000):
+        self.data_dir = data_dir
+        self.shard_size = max(1, shard_size)
+        self.shard_file = None
+        self.shard_name = None
+        self.shard_count = 0
+        self.shard_questions = 0
+        os.makedirs(data_dir, exist_ok=True)
+        self.index_file = open(os.path.join(data_dir, 'index.jsonl'), 'w')
+
+    def write(self, exam, year, questao):
+        if self.shard_file is None or self.shard_questions == self.shard_size:
+            self.next_shard()
+        line = (json.dumps(questao, ensure_ascii=False) + '\n').encode('utf-8')
+        offset = self.shard_file.tell()
+        self.shard_file.write(line)
+        self.shard_questions += 1
+        entry = {
+            'exam': exam,
+            'year': year,
+            'question': questao['original_question_num'],
+            'shard': self.shard_name,
+            'offset': offset,
+            'length': len(line),
+        }
+        self.index_file.write(json.dumps(entry) + '\n')
+
+    def next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        self.shard_name = f'shard-{self.shard_count:05d}.jsonl'
+        self.shard_file = open(os.path.join(self.data_dir, self.shard_name), 'wb')
+        self.shard_count += 1
+        self.shard_questions = 0
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        self.index_file.close()
+
+def sync_images(src_images_dir, images_dir):
+    """Hardlinks (or copies) into `images_dir` the images that are missing or changed, returning how many were placed."""
+    placed = 0
+    for filename in sorted(os.listdir(src_images_dir)):
+        source_path = os.path.join(src_images_dir, filename)
+        target_path = os.path.join(images_dir, filename)
+        if not os.path.isfile(source_path):
+            continue
+        if os.path.exists(target_path) and (os.path.samefile(source_path, target_path) or filecmp.cmp(source_path, target_path)):
+            continue
+        link_or_copy(source_path, target_path)
+        placed += 1
+    return placed
+
+def parsed_years(prova_dir):
+    """(year directory, year) of the years of `prova_dir` that have a prova.json, in order."""
+    for year in sorted(os.listdir(prova_dir)):
+        # skips the merged images/ directory and years that were not parsed
+        if os.path.exists(os.path.join(prova_dir, year, 'prova.json')):
+            yield os.path.join(prova_dir, year), int(year) if year.isdigit() else year
+
+def find_parallel_questions(prova_dir, exam, parallel_index):
+    """
+    Adds the questions of every year of `prova_dir` to the near-duplicate index (one year
+    in memory at a time) and returns its groups of parallel questions, see dedup.ParallelQuestionIndex.
+    """
+    keys = set()
+    for year_path, year in parsed_years(prova_dir):
+        with open(os.path.join(year_path, 'prova.json'), 'r') as file:
+            for questao in json.load(file):
+                keys.add(parallel_index.add(exam, year, questao, os.path.join(year_path, 'new_images')))
+    # questions too short to be compared are dropped from the index too
+    keys.discard(None)
+    parallel_index.prune(exam, keys)
+    groups = parallel_index.groups()
+    exam_groups = {group['id']: group for key, group in groups.items() if key in keys}
+    exact = sum(len(group['duplicates']) for group in exam_groups.values())
+    print(f"Found {len(exam_groups)} group(s) of parallel questions ({exact} exact duplicates), "
+          f"{parallel_index.added} question(s) indexed, {parallel_index.reused} unchanged")
+    for group in sorted(exam_groups.values(), key=lambda group: question_order(group['id'])):
+        for copies in group['duplicates']:
+            print(f"Warning: duplicated question {', '.join(copies)}")
+    save_parallel_report(exam_groups, os.path.join(prova_dir, 'parallel_questions.json'))
+    return groups
+
+def save_parallel_report(groups, path):
+    with open(path, 'w') as report_file:
+        json.dump(sorted(groups.values(), key=lambda group: question_order(group['id'])), report_file, indent=4, ensure_ascii=False)
+
+def merge_json_files(prova_dir, shard_size=1000, parallel_index=None):
+    """
+    Merges the prova.json of every year one year at a time, so memory doesn't grow
+    with the corpus. Writes data.json, the JSONL shards and index of <prova_dir>/data
+    and places the images of every year in <prova_dir>/images. With a `parallel_index`
+    the parallel_question_id of every question is set to the id of its group of
+    near-duplicate questions (across years and exams in the same index).
+    """
+    exam = os.path.basename(os.path.normpath(prova_dir))
+    groups = {}
+    if parallel_index is not None:
+        groups = find_parallel_questions(prova_dir, exam, parallel_index)
+    images_dir = os.path.join(prova_dir, 'images')
+    data_dir = os.path.join(prova_dir, 'data')
+    # everything is written next to the previous output first and only replaces it at the end
+    tmp_data_dir = f'{data_dir}.tmp'
+    shutil.rmtree(tmp_data_dir, ignore_errors=True)
+    writer = ShardWriter(tmp_data_dir, shard_size)
+    os.makedirs(images_dir, exist_ok=True)
+    questions, placed = 0, 0
+    with open(os.path.join(prova_dir, 'data.json.tmp'), 'w') as outfile:
+        outfile.write('[')
+        for year_path, year in parsed_years(prova_dir):
+            with open(os.path.join(year_path, 'prova.json'), 'r') as file:
+                data = json.load(file)
+            for questao in data:
+                group = groups.get(ParallelQuestionIndex.make_key(exam, year, questao['original_question_num']))
+                if group is not None:
+                    questao['parallel_question_id'] = group['id']
+                outfile.write(', ' if questions else '')
+                json.dump(questao, outfile)
+                writer.write(exam, year, questao)
+                questions += 1
+            src_images_dir = os.path.join(year_path, 'new_images')
+            if os.path.isdir(src_images_dir):
+                placed += sync_images(src_images_dir, images_dir)
+        outfile.write(']')
+    writer.close()
+    os.replace(os.path.join(prova_dir, 'data.json.tmp'), os.path.join(prova_dir, 'data.json'))
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.replace(tmp_data_dir, data_dir)
+    print(f"Merged {questions} questions into {writer.shard_count} shard(s), {placed} new or changed image(s)")
+    return questions
+
+# ! =============== RANDOM ACCESS ===============
+
+def load_index(data_dir):
+    """{(exam, year, question number): index entry} of a merged dataset."""
+    index = {}
+    with open(os.path.join(data_dir, 'index.jsonl'), 'r') as index_file:
+        for line in index_file:
+            entry = json.loads(line)
+            index[(entry['exam'], entry['year'], entry['question'])] = entry
+    return index
+
+def read_question(data_dir, entry):
+    """Reads a single question of the merged dataset from its index entry."""
+    with open(os.path.join(data_dir, entry['shard']), 'rb') as shard_file:
+        shard_file.seek(entry['offset'])
+        return json.loads(shard_file.read(entry['length']).decode('utf-8'))
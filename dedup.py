@@ -0,0 +1,429 @@
+import os
+import re
+import sqlite3
+import filecmp
+import hashlib
+import operator
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from utils import link_or_copy
+
+# ! =============== NEAR-DUPLICATE QUESTIONS ===============
+
+# options that are image filenames say nothing about the question content
+IMAGE_OPTION_PATTERN = re.compile(r'\.(png|jpe?g|gif|bmp|webp|eps|pdf)$', re.IGNORECASE)
+# questions without images and with fewer words than this ("Observe a figura.") are not indexed,
+# their text alone can't tell them apart
+MIN_WORDS = 6
+
+def normalize_question(questao):
+    """Question text plus text options, lowercased, without accents, LaTeX commands or punctuation."""
+    parts = [questao['question']] + [option for option in questao['options'] if not IMAGE_OPTION_PATTERN.search(option.strip())]
+    text = unicodedata.normalize('NFKD', ' '.join(parts).lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r'\\[a-z]+', ' ', text)
+    return ' '.join(re.findall(r'[a-z0-9]+', text))
+
+def shingles(text, size=3):
+    """Stable 64-bit hashes of the word `size`-grams of a normalized text."""
+    words = text.split()
+    grams = [' '.join(words[start:start+size]) for start in range(max(1, len(words) - size + 1))]
+    return {int.from_bytes(hashlib.blake2b(gram.encode('utf-8'), digest_size=8).digest(), 'big') for gram in grams}
+
+def question_images(questao):
+    """Filenames of the images of a question: the one of its text and the image options."""
+    options = [option.strip() for option in questao['options'] if IMAGE_OPTION_PATTERN.search(option.strip())]
+    return ([questao['image_png']] if questao['image_png'] else []) + options
+
+def image_shingles(images_dir, filenames):
+    """64-bit hashes of the contents of the images, so questions with the same short text but other images differ."""
+    values = set()
+    for filename in filenames:
+        path = os.path.join(images_dir, filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as image_file:
+                values.add(int.from_bytes(hashlib.blake2b(image_file.read(), digest_size=8).digest(), 'big'))
+    return values
+
+def lsh_bands(threshold, num_perm):
+    """
+    Number of LSH bands (of num_perm / bands rows each) whose approximate similarity
+    threshold, (1 / bands) ** (1 / rows), is the highest one not above `threshold`,
+    so few true matches are missed and the extra candidates are dropped on verification.
+    """
+    best = num_perm
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands == 0 and (1 / bands) ** (bands / num_perm) <= threshold:
+            best = bands
+            break
+    return best
+
+class ParallelQuestionIndex:
+    """
+    Persistent MinHash/LSH index of the questions of every exam, stored in a SQLite file.
+    Questions are added one at a time and their signature is only computed again when
+    their normalized text changes. Each signature is split in bands and only questions
+    sharing a band bucket are compared, so grouping the near-duplicates doesn't need
+    to compare every pair of questions.
+    """
+    def __init__(self, path, threshold=0.8, num_perm=128):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = lsh_bands(threshold, num_perm)
+        self.rows = num_perm // self.bands
+        self.added = 0
+        self.reused = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS questions (
+                    key TEXT PRIMARY KEY,
+                    exam TEXT NOT NULL,
+                    year INTEGER NOT NULL,
+                    question INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    signature BLOB NOT NULL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    band INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (band, bucket, key)
+                )
+            """)
+            self.conn.execute('CREATE INDEX IF NOT EXISTS buckets_by_key ON buckets (key)')
+            # signatures built with other parameters can't be compared, so the index starts over
+            self.conn.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            settings = f'{num_perm}:{self.bands}'
+            row = self.conn.execute("SELECT value FROM settings WHERE name = 'minhash'").fetchone()
+            if row is not None and row[0] != settings:
+                self.conn.execute('DELETE FROM questions')
+                self.conn.execute('DELETE FROM buckets')
+            self.conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('minhash', ?)", (settings,))
+
+    @staticmethod
+    def make_key(exam, year, question_number):
+        return f'{exam}/{year}/{question_number}'
+
+    def signature(self, values):
+        """
+        One permutation MinHash: the shingle hashes are split in `num_perm` bins by value and each
+        bin keeps its minimum, so the signature costs one pass over the shingles instead of one per
+        permutation. Empty bins take the value of the next non-empty bin (rotation densification).
+        """
+        signature = [None] * self.num_perm
+        for value in values:
+            bin_idx, bin_value = value % self.num_perm, value // self.num_perm
+            if signature[bin_idx] is None or bin_value < signature[bin_idx]:
+                signature[bin_idx] = bin_value
+        # bigger than any bin value, so borrowed values never collide with the bin's own ones (and still fit in 64 bits)
+        offset = (1 << 64) // self.num_perm
+        empty = {bin_idx for bin_idx, value in enumerate(signature) if value is None}
+        for bin_idx in empty:
+            distance = next(step for step in range(1, self.num_perm) if (bin_idx + step) % self.num_perm not in empty)
+            signature[bin_idx] = signature[(bin_idx + distance) % self.num_perm] + distance * offset
+        return signature
+
+    def add(self, exam, year, questao, images_dir=None):
+        """
+        Indexes a question of the merged dataset, returning its key, or None for questions
+        with too little text to be compared (left out of the index, see prune). The contents
+        of its images in `images_dir` are part of the signature.
+        """
+        key = self.make_key(exam, year, questao['original_question_num'])
+        text = normalize_question(questao)
+        images = image_shingles(images_dir, question_images(questao)) if images_dir is not None else set()
+        if not images and len(text.split()) < MIN_WORDS:
+            return None
+        digest = hashlib.sha256(f"{text}\0{','.join(map(str, sorted(images)))}".encode('utf-8')).hexdigest()
+        row = self.conn.execute('SELECT digest FROM questions WHERE key = ?', (key,)).fetchone()
+        if row is not None and row[0] == digest:
+            self.reused += 1
+            return key
+        signature = self.signature((shingles(text) if text else set()) | images)
+        # committed by prune, once the whole exam was added
+        self.conn.execute('DELETE FROM buckets WHERE key = ?', (key,))
+        self.conn.execute(
+            'INSERT OR REPLACE INTO questions (key, exam, year, question, digest, signature) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, exam, year, questao['original_question_num'], digest, array('Q', signature).tobytes())
+        )
+        self.conn.executemany('INSERT OR IGNORE INTO buckets (band, bucket, key) VALUES (?, ?, ?)', [
+            (band, hashlib.blake2b(array('Q', signature[band*self.rows:(band+1)*self.rows]).tobytes(), digest_size=8).hexdigest(), key)
+            for band in range(self.bands)
+        ])
+        self.added += 1
+        return key
+
+    def prune(self, exam, keys):
+        """Drops the questions of `exam` that are not in `keys` anymore (removed years or questions)."""
+        stale = [(key,) for (key,) in self.conn.execute('SELECT key FROM questions WHERE exam = ?', (exam,)) if key not in keys]
+        with self.conn:
+            self.conn.executemany('DELETE FROM questions WHERE key = ?', stale)
+            self.conn.executemany('DELETE FROM buckets WHERE key = ?', stale)
+        return len(stale)
+
+    def load_signature(self, key):
+        row = self.conn.execute('SELECT signature, digest FROM questions WHERE key = ?', (key,)).fetchone()
+        return array('Q', row[0]), row[1]
+
+    def groups(self):
+        """
+        Groups of parallel questions as {key: group}, where a group is a dict with its `id`
+        (the key of its first question), its `questions` and the `duplicates`, lists of its
+        questions with the exact same text and images. Questions of the same exam year are never
+        paired with each other, as questions sharing a support text are not parallel questions.
+        """
+        parents = {}
+
+        def find(key):
+            while parents.get(key, key) != key:
+                key = parents[key]
+            return key
+
+        signatures = {}
+        compared = set()
+        candidates = self.conn.execute('SELECT GROUP_CONCAT(key, char(10)) FROM buckets GROUP BY band, bucket HAVING COUNT(*) > 1')
+        for (keys,) in candidates:
+            keys = sorted(keys.split('\n'))
+            for position, first in enumerate(keys):
+                for second in keys[position+1:]:
+                    # same exam year, or already known to be in the same group
+                    if (first, second) in compared or first.rsplit('/', 1)[0] == second.rsplit('/', 1)[0] or find(first) == find(second):
+                        continue
+                    compared.add((first, second))
+                    for key in (first, second):
+                        if key not in signatures:
+                            signatures[key] = self.load_signature(key)
+                    first_signature, first_digest = signatures[first]
+                    second_signature, second_digest = signatures[second]
+                    similarity = sum(map(operator.eq, first_signature, second_signature)) / self.num_perm
+                    if similarity >= self.threshold or first_digest == second_digest:
+                        parents.setdefault(first, first)
+                        parents.setdefault(second, second)
+                        parents[find(second)] = find(first)
+
+        members = {}
+        for key in parents:
+            members.setdefault(find(key), []).append(key)
+        groups = {}
+        for keys in members.values():
+            keys = sorted(keys, key=question_order)
+            # a group can hold exact copies next to edited ones, so they are listed apart
+            by_digest = {}
+            for key in keys:
+                by_digest.setdefault(signatures[key][1], []).append(key)
+            group = {
+                'id': keys[0],
+                'questions': keys,
+                'duplicates': [copies for copies in by_digest.values() if len(copies) > 1],
+            }
+            for key in keys:
+                groups[key] = group
+        return groups
+
+    def close(self):
+        self.conn.close()
+
+def question_order(key):
+    exam, year, question = key.rsplit('/', 2)
+    # numeric years sort by length first so 2014 comes before 10000 and other names after them
+    return (exam, len(year), year, int(question))
+
+# ! =============== NEAR-DUPLICATE IMAGES ===============
+
+# side of the difference hash grid, the hash has HASH_SIZE ** 2 bits
+HASH_SIZE = 16
+
+def perceptual_hash(path):
+    """
+    Difference hash of an image: each bit tells whether a pixel of the grayscale,
+    (HASH_SIZE + 1) x HASH_SIZE thumbnail is brighter than its right neighbour.
+    Returns the hash, the image size and its average color.
+    """
+    with Image.open(path) as image:
+        size = image.size
+        # decodes JPEGs directly at a reduced scale
+        image.draft('RGB', (HASH_SIZE * 4, HASH_SIZE * 4))
+        image = image.convert('RGB')
+        color = image.resize((1, 1), Image.BOX).getpixel((0, 0))
+        pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            value = (value << 1) | (pixels[row * (HASH_SIZE + 1) + col + 1] > left)
+    return value, size, color
+
+def similar_shape(size, other_size, tolerance=0.02):
+    """Whether two images have the same aspect ratio, the hash alone ignores it."""
+    first, second = size[0] * other_size[1], other_size[0] * size[1]
+    return abs(first - second) <= tolerance * max(first, second)
+
+def similar_color(color, other_color, tolerance=24):
+    """Whether two images have about the same average color, the hash only sees brightness changes (flat images all hash to 0)."""
+    return all(abs(channel - other_channel) <= tolerance for channel, other_channel in zip(color, other_color))
+
+def pack_color(color):
+    return (color[0] << 16) | (color[1] << 8) | color[2]
+
+def unpack_color(value):
+    return (value >> 16) & 255, (value >> 8) & 255, value & 255
+
+class ImageIndex:
+    """
+    Persistent perceptual-hash index of the staged images of every year, stored in a SQLite file.
+    Images whose hashes differ in at most `max_distance` bits (and have the same aspect ratio
+    and average color) form a group, and the image type of the group's first successful
+    classification by `model_name` is reused by the other questions. Only byte-identical copies
+    of the group's first image (its canonical file) are replaced by hardlinks to it, as near-duplicates
+    may differ in a label or an arrow that matters for the question. Hashes are split in `max_distance` + 1
+    chunks, any hash close enough shares at least one chunk with the group hash, so lookups
+    only compare the groups found through the chunks.
+    """
+    def __init__(self, path, model_name, max_distance=8):
+        self.model_name = model_name
+        self.max_distance = max_distance
+        self.chunks = max_distance + 1
+        self.chunk_bits = -(-HASH_SIZE ** 2 // self.chunks)
+        self.deduplicated = 0
+        self.reused_types = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS image_groups (
+                    group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    hash TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    color INTEGER NOT NULL,
+                    canonical TEXT NOT NULL
+                )
+            """)
+            # answers differ between models, so each model keeps its own image type for a group
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS image_types (
+                    group_id INTEGER NOT NULL,
+                    model_name TEXT NOT NULL,
+                    image_type TEXT NOT NULL,
+                    PRIMARY KEY (group_id, model_name)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS image_chunks (
+                    chunk INTEGER NOT NULL,
+                    value INTEGER NOT NULL,
+                    group_id INTEGER NOT NULL,
+                    PRIMARY KEY (chunk, value, group_id)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    group_id INTEGER NOT NULL
+                )
+            """)
+            # the chunks depend on max_distance, so they are rebuilt from the group hashes when it changes
+            self.conn.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            row = self.conn.execute("SELECT value FROM settings WHERE name = 'chunks'").fetchone()
+            if row is not None and row[0] != str(self.chunks):
+                self.conn.execute('DELETE FROM image_chunks')
+                for group_id, group_hash in self.conn.execute('SELECT group_id, hash FROM image_groups').fetchall():
+                    self.insert_chunks(int(group_hash, 16), group_id)
+            self.conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('chunks', ?)", (str(self.chunks),))
+
+    def split(self, value):
+        mask = (1 << self.chunk_bits) - 1
+        return [(value >> (chunk * self.chunk_bits)) & mask for chunk in range(self.chunks)]
+
+    def find_group(self, value, size, color):
+        candidates = set()
+        for chunk, chunk_value in enumerate(self.split(value)):
+            candidates.update(group_id for (group_id,) in self.conn.execute(
+                'SELECT group_id FROM image_chunks WHERE chunk = ? AND value = ?', (chunk, chunk_value)
+            ))
+        best = None
+        for group_id in sorted(candidates):
+            group_hash, width, height, group_color = self.conn.execute(
+                'SELECT hash, width, height, color FROM image_groups WHERE group_id = ?', (group_id,)
+            ).fetchone()
+            distance = bin(int(group_hash, 16) ^ value).count('1')
+            if distance > self.max_distance or not similar_shape(size, (width, height)) or not similar_color(color, unpack_color(group_color)):
+                continue
+            if best is None or distance < best[0]:
+                best = (distance, group_id)
+        return best[1] if best else None
+
+    def new_group(self, value, size, color, path):
+        group_id = self.conn.execute(
+            'INSERT INTO image_groups (hash, width, height, color, canonical) VALUES (?, ?, ?, ?, ?)',
+            (f'{value:x}', size[0], size[1], pack_color(color), path)
+        ).lastrowid
+        self.insert_chunks(value, group_id)
+        return group_id
+
+    def insert_chunks(self, value, group_id):
+        self.conn.executemany('INSERT INTO image_chunks (chunk, value, group_id) VALUES (?, ?, ?)', [
+            (chunk, chunk_value, group_id) for chunk, chunk_value in enumerate(self.split(value))
+        ])
+
+    def assign_all(self, paths, max_workers=1):
+        """
+        Places each image in its group, replacing identical copies by a hardlink (or copy) of the
+        group's canonical file, and returns {path: group id}. Images unchanged since the last run
+        keep their group without being hashed again, the others are hashed in a thread pool.
+        """
+        paths = sorted({os.path.normpath(path) for path in paths})
+        groups, pending = {}, []
+        for path in paths:
+            stat = os.stat(path)
+            row = self.conn.execute('SELECT size, mtime_ns, group_id FROM images WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                groups[path] = row[2]
+            else:
+                pending.append(path)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            hashes = list(executor.map(perceptual_hash, pending))
+        with self.conn:
+            for path, (value, size, color) in zip(pending, hashes):
+                group_id = self.find_group(value, size, color)
+                if group_id is None:
+                    group_id = self.new_group(value, size, color, path)
+                else:
+                    canonical = self.conn.execute('SELECT canonical FROM image_groups WHERE group_id = ?', (group_id,)).fetchone()[0]
+                    if not os.path.exists(canonical):
+                        # the canonical file was removed with its year, this image takes its place
+                        self.conn.execute('UPDATE image_groups SET canonical = ? WHERE group_id = ?', (path, group_id))
+                    elif not os.path.samefile(canonical, path) and filecmp.cmp(canonical, path, shallow=False):
+                        link_or_copy(canonical, path)
+                        self.deduplicated += 1
+                stat = os.stat(path)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO images (path, size, mtime_ns, group_id) VALUES (?, ?, ?, ?)',
+                    (path, stat.st_size, stat.st_mtime_ns, group_id)
+                )
+                groups[path] = group_id
+        return groups
+
+    def group_type(self, group_id):
+        row = self.conn.execute(
+            'SELECT image_type FROM image_types WHERE group_id = ? AND model_name = ?', (group_id, self.model_name)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record_type(self, group_id, image_type):
+        """Keeps the first successful classification of each group."""
+        if image_type == 'unknown':
+            return
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO image_types (group_id, model_name, image_type) VALUES (?, ?, ?)', (group_id, self.model_name, image_type)
+            )
+
+    def close(self):
+        self.conn.close()
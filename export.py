@@ -0,0 +1,146 @@
+import os
+import json
+import argparse
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# ! =============== COLUMNAR EXPORT ===============
+
+EXPORT_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+# keys of the question dict built in parse_prova, in column order
+QUESTION_COLUMNS = [
+    'language', 'country', 'file_name', 'source', 'license', 'level', 'category_en', 'category_original_lang',
+    'original_question_num', 'question', 'options', 'answer', 'image_png', 'image_information', 'image_type',
+    'parallel_question_id',
+]
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is needed to export the dataset, install it with `pip install pyarrow`')
+
+def question_schema(embed_images=False):
+    """Typed columns of the question dict built in parse_prova, with repeated strings dictionary-encoded."""
+    require_pyarrow()
+    category = pa.dictionary(pa.int32(), pa.string())
+    fields = [
+        pa.field('exam', category),
+        pa.field('year', pa.int16()),
+        pa.field('language', category),
+        pa.field('country', category),
+        pa.field('file_name', category),
+        pa.field('source', category),
+        pa.field('license', category),
+        pa.field('level', category),
+        pa.field('category_en', category),
+        pa.field('category_original_lang', category),
+        pa.field('original_question_num', pa.int16()),
+        pa.field('question', pa.string()),
+        pa.field('options', pa.list_(pa.string())),
+        pa.field('answer', pa.int8()),
+        pa.field('image_png', pa.string()),
+        pa.field('image_information', category),
+        pa.field('image_type', category),
+        pa.field('parallel_question_id', pa.string()),
+    ]
+    if embed_images:
+        fields += [
+            pa.field('image_bytes', pa.binary()),
+            # only set when the alternatives are images
+            pa.field('option_image_bytes', pa.list_(pa.binary())),
+        ]
+    return pa.schema(fields)
+
+def read_image(images_dir, filename):
+    path = os.path.join(images_dir, filename or '')
+    if not filename or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as image_file:
+        return image_file.read()
+
+def shard_to_batch(shard_path, exam_by_offset, schema, images_dir=None):
+    """Record batch with the questions of one JSONL shard of the merged dataset."""
+    columns = {field.name: [] for field in schema}
+    with open(shard_path, 'rb') as shard_file:
+        offset = 0
+        for line in shard_file:
+            questao = json.loads(line)
+            exam, year = exam_by_offset[offset]
+            offset += len(line)
+            questao['image_png'] = questao['image_png'] or None
+            columns['exam'].append(exam)
+            columns['year'].append(year)
+            for name in QUESTION_COLUMNS:
+                columns[name].append(questao.get(name))
+            if images_dir is not None:
+                columns['image_bytes'].append(read_image(images_dir, questao['image_png']))
+                option_images = [read_image(images_dir, option) for option in questao['options']]
+                columns['option_image_bytes'].append(option_images if all(option_images) and option_images else None)
+    return pa.record_batch([pa.array(columns[field.name], type=field.type) for field in schema], schema=schema)
+
+def export_dataset(prova_dir, export_format='parquet', embed_images=False):
+    """
+    Writes the merged dataset of `prova_dir` (see dataset.merge_json_files) to
+    <prova_dir>/data.parquet or data.arrow, one record batch per shard, so memory
+    stays bounded by the shard size. With `embed_images` the image files are
+    stored inline in the image_bytes/option_image_bytes columns.
+    """
+    require_pyarrow()
+    if export_format not in EXPORT_EXTENSIONS:
+        raise ValueError(f"Unsupported export format {export_format!r}, use one of {list(EXPORT_EXTENSIONS)}")
+    data_dir = os.path.join(prova_dir, 'data')
+    images_dir = os.path.join(prova_dir, 'images') if embed_images else None
+    schema = question_schema(embed_images)
+    # {shard: {byte offset: (exam, year)}}
+    shards = {}
+    with open(os.path.join(data_dir, 'index.jsonl'), 'r') as index_file:
+        for line in index_file:
+            entry = json.loads(line)
+            shards.setdefault(entry['shard'], {})[entry['offset']] = (entry['exam'], entry['year'])
+
+    export_path = os.path.join(prova_dir, f'data.{EXPORT_EXTENSIONS[export_format]}')
+    tmp_path = f'{export_path}.tmp'
+    if export_format == 'parquet':
+        writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+        write = writer.write_batch
+    else:
+        # uncompressed, so loaders can memory-map the columns without copying them
+        sink = pa.OSFile(tmp_path, 'wb')
+        writer = pa.ipc.new_file(sink, schema)
+        write = writer.write_batch
+    rows = 0
+    try:
+        for shard in sorted(shards):
+            batch = shard_to_batch(os.path.join(data_dir, shard), shards[shard], schema, images_dir)
+            write(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+        if export_format == 'arrow':
+            sink.close()
+    os.replace(tmp_path, export_path)
+    print(f"Exported {rows} questions to {export_path}")
+    return export_path
+
+def load_dataset(path, columns=None):
+    """Memory-maps an exported dataset, reading only `columns` (all of them by default)."""
+    require_pyarrow()
+    if path.endswith('.parquet'):
+        return pq.read_table(path, columns=columns, memory_map=True)
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.select(columns) if columns else table
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--prova_dir', help='Diretório em que as provas estão armazenadas seguindo a estrutura de pastas presente no README.')
+parser.add_argument('--format', default='parquet', choices=list(EXPORT_EXTENSIONS), help='Formato colunar do arquivo exportado.')
+parser.add_argument('--embed_images', action='store_true', help='Inclui os bytes das imagens no arquivo exportado.')
+
+def main() -> None:
+    args = parser.parse_args()
+    export_dataset(f'./{args.prova_dir}', args.format, args.embed_images)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import argparse
+from validation import validate_year, print_validation_summary, has_errors, RULES_VERSION
+from utils import list_exam_years
+
+# ! =============== OFFLINE LINT ===============
+
+# only the parsing and validation code is imported here (no Gemini client, PIL or network),
+# so checking a prova.tex takes a fraction of a second
+
+LINT_CACHE_FILE = '.lint_cache.json'
+# files of a year whose changes trigger a new check in --watch mode
+LINT_INPUTS = ('prova.tex', 'gabarito.tex')
+
+def load_lint_cache(path):
+    """{question hash: problems} saved by an earlier run, see validation.validate_exam."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    return cache['questions'] if cache.get('rules_version') == RULES_VERSION else {}
+
+def save_lint_cache(path, cache, used):
+    """Only the questions in `used`, {year: question hashes of its last check}, are kept, so edited questions don't pile up."""
+    keys = set().union(*used.values())
+    for key in set(cache) - keys:
+        del cache[key]
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        json.dump({'rules_version': RULES_VERSION, 'questions': cache}, cache_file)
+    os.replace(tmp_path, path)
+
+def input_mtimes(year_path):
+    return tuple(os.stat(os.path.join(year_path, name)).st_mtime_ns if os.path.exists(os.path.join(year_path, name)) else None
+                 for name in LINT_INPUTS)
+
+def lint_years(base_path, years, cache, used):
+    issues = []
+    for year in years:
+        keys = set()
+        issues += validate_year(os.path.join(base_path, year), int(year), cache, keys)
+        used[year] = keys
+    return issues
+
+def watch(base_path, years, cache, used, cache_path, interval=0.3):
+    """
+    Polls the prova.tex and gabarito.tex of every year and checks again only the
+    year whose files changed (its unchanged questions come from the cache).
+    """
+    watched = years or list_exam_years(base_path)
+    mtimes = {year: input_mtimes(os.path.join(base_path, year)) for year in watched}
+    print(f"Watching {len(watched)} year(s) in {base_path}, press Ctrl-C to stop")
+    while True:
+        time.sleep(interval)
+        # years added while watching are picked up too, unless --years was given
+        for year in years or list_exam_years(base_path):
+            current = input_mtimes(os.path.join(base_path, year))
+            if mtimes.get(year) == current:
+                continue
+            mtimes[year] = current
+            start_time = time.perf_counter()
+            try:
+                issues = lint_years(base_path, [year], cache, used)
+            except OSError as error:
+                # the editor may be in the middle of saving the file
+                print(f"Warning: could not read year {year}: {error}")
+                continue
+            print(f"\n[{time.strftime('%H:%M:%S')}] {year} changed")
+            print_validation_summary(issues, [year])
+            print(f"Checked in {(time.perf_counter() - start_time) * 1000:.0f}ms")
+            save_lint_cache(cache_path, cache, used)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--prova_dir', help='Diretório em que as provas estão armazenadas seguindo a estrutura de pastas presente no README.')
+parser.add_argument('--years', nargs='*', help='Anos a serem verificados (por padrão, todos os anos em --prova_dir).')
+parser.add_argument('--watch', action='store_true', help='Continua rodando e verifica novamente cada ano assim que seu prova.tex ou gabarito.tex é salvo.')
+parser.add_argument('--interval', type=float, default=0.3, help='Intervalo, em segundos, entre as verificações de arquivos alterados no modo --watch.')
+parser.add_argument('--no_cache', action='store_true', help=f'Verifica todas as questões novamente, ignorando o cache em <prova_dir>/{LINT_CACHE_FILE}.')
+
+def main() -> None:
+    args = parser.parse_args()
+    base_path = f'./{args.prova_dir}'
+    cache_path = os.path.join(base_path, LINT_CACHE_FILE)
+    cache = {} if args.no_cache else load_lint_cache(cache_path)
+    years = args.years or list_exam_years(base_path)
+    used = {}
+    start_time = time.perf_counter()
+    issues = lint_years(base_path, years, cache, used)
+    print_validation_summary(issues, years)
+    print(f"Checked in {(time.perf_counter() - start_time) * 1000:.0f}ms")
+    save_lint_cache(cache_path, cache, used)
+    if args.watch:
+        try:
+            watch(base_path, args.years, cache, used, cache_path, args.interval)
+        except KeyboardInterrupt:
+            save_lint_cache(cache_path, cache, used)
+        return
+    if has_errors(issues):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import time
+import json
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+
+# ! =============== RUN METRICS ===============
+
+# upper bounds, in seconds, of the latency histogram buckets (the last bucket has no bound)
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60]
+
+class RunMetrics:
+    """
+    Thread-safe collector for one exam year: wall/CPU time per stage and per question,
+    latency, errors and token usage of every model call, retries, time spent waiting
+    for the rate limiter and cache hit rates. `report` returns it as a JSON-ready dict.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.questions = {}
+        self.calls = {}
+        self.retries = {}
+        self.rate_limit_wait = 0.0
+        self.cache = {}
+
+    @contextmanager
+    def stage(self, name, question=None):
+        """
+        Times the block as stage `name`, or as a step of `question`. Stages use the CPU time of
+        the whole process (their work may run in thread pools), questions the one of the thread.
+        """
+        cpu_clock = time.process_time if question is None else time.thread_time
+        wall_start, cpu_start = time.perf_counter(), cpu_clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - wall_start, cpu_clock() - cpu_start, question)
+
+    def add_time(self, name, wall_seconds, cpu_seconds=0.0, question=None):
+        with self.lock:
+            timings = self.stages if question is None else self.questions.setdefault(question, {})
+            entry = timings.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            entry['calls'] += 1
+            entry['wall_seconds'] += wall_seconds
+            entry['cpu_seconds'] += cpu_seconds
+
+    def record_call(self, kind, seconds, error=None, usage=None):
+        with self.lock:
+            entry = self.calls.setdefault(kind, {
+                'calls': 0, 'errors': {}, 'latencies': [],
+                'prompt_tokens': 0, 'output_tokens': 0, 'total_tokens': 0,
+            })
+            entry['calls'] += 1
+            entry['latencies'].append(seconds)
+            if error is not None:
+                entry['errors'][error.__class__.__name__] = entry['errors'].get(error.__class__.__name__, 0) + 1
+            if usage is not None:
+                entry['prompt_tokens'] += getattr(usage, 'prompt_token_count', 0) or 0
+                entry['output_tokens'] += getattr(usage, 'candidates_token_count', 0) or 0
+                entry['total_tokens'] += getattr(usage, 'total_token_count', 0) or 0
+
+    def record_retry(self, name):
+        with self.lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def record_rate_limit_wait(self, seconds):
+        with self.lock:
+            self.rate_limit_wait += seconds
+
+    def set_cache_stats(self, name, stats):
+        self.cache[name] = stats
+
+    def report(self):
+        with self.lock:
+            calls = {}
+            for kind, entry in self.calls.items():
+                calls[kind] = {key: value for key, value in entry.items() if key != 'latencies'}
+                calls[kind].update(latency_summary(entry['latencies']))
+            return {
+                'stages': {name: dict(entry) for name, entry in self.stages.items()},
+                'questions': {str(question): {name: dict(entry) for name, entry in steps.items()}
+                              for question, steps in sorted(self.questions.items())},
+                'calls': calls,
+                'retries': dict(self.retries),
+                'rate_limit_wait_seconds': self.rate_limit_wait,
+                'cache': dict(self.cache),
+            }
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def latency_summary(latencies):
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    for seconds in latencies:
+        histogram[next((idx for idx, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))] += 1
+    values = sorted(latencies)
+    return {
+        'latency_histogram': {f'<={bound}s': count for bound, count in zip(LATENCY_BUCKETS, histogram)} | {f'>{LATENCY_BUCKETS[-1]}s': histogram[-1]},
+        'latency_p50': percentile(values, 0.5) if values else None,
+        'latency_p95': percentile(values, 0.95) if values else None,
+        'latency_max': values[-1] if values else None,
+        'latency_total': sum(values),
+    }
+
+def combine_reports(reports):
+    """Totals of several year reports (per-question timings and percentiles are only kept per year)."""
+    totals = {'stages': {}, 'calls': {}, 'retries': {}, 'rate_limit_wait_seconds': 0.0}
+    for report in reports:
+        for name, entry in report['stages'].items():
+            total = totals['stages'].setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            for key in total:
+                total[key] += entry[key]
+        for kind, entry in report['calls'].items():
+            total = totals['calls'].setdefault(kind, {
+                'calls': 0, 'errors': {}, 'prompt_tokens': 0, 'output_tokens': 0, 'total_tokens': 0,
+                'latency_total': 0.0, 'latency_histogram': dict.fromkeys(entry['latency_histogram'], 0),
+            })
+            for key in ('calls', 'prompt_tokens', 'output_tokens', 'total_tokens', 'latency_total'):
+                total[key] += entry[key]
+            for name, count in entry['errors'].items():
+                total['errors'][name] = total['errors'].get(name, 0) + count
+            for bucket, count in entry['latency_histogram'].items():
+                total['latency_histogram'][bucket] += count
+        for name, count in report['retries'].items():
+            totals['retries'][name] = totals['retries'].get(name, 0) + count
+        totals['rate_limit_wait_seconds'] += report['rate_limit_wait_seconds']
+    return totals
+
+def save_run_report(path, years, totals, config, failed=None):
+    """`failed` maps the years that failed to their error, their metrics are in `years` too."""
+    report = {'config': config, 'totals': totals, 'years': years, 'failed': failed or {}}
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=4, default=str)
+
+# ! =============== PROFILING ===============
+
+class QuestionProfiler:
+    """
+    cProfile hook for a single question: only the blocks run under `profile(question)` for
+    `question_number` are profiled, including its Gemini requests in the worker threads.
+    """
+    def __init__(self, question_number):
+        self.question_number = question_number
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    @contextmanager
+    def profile(self, question_number):
+        if question_number != self.question_number:
+            yield
+            return
+        # only one profiler can be active at a time, so the requests of this question run one after the other
+        with self.lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                self.profiles.append(profiler)
+
+    def save(self, path, top=20):
+        if not self.profiles:
+            return
+        stats = pstats.Stats(self.profiles[0])
+        for profiler in self.profiles[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        print(f"Profile of question {self.question_number} saved to {path}, top {top} functions by cumulative time:")
+        stats.sort_stats('cumulative').print_stats(top)
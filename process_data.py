@@ -1,161 +1,588 @@
 import os
 from tqdm import tqdm
-import google.generativeai as genai
 import argparse
-import json
-import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from utils import *
+from cache import ClassificationCache, UploadRegistry, BuildManifest, file_sha256
+from backends import GEMINI_MODEL_NAME, GeminiBackend, InstrumentedBackend, make_backend
+from metrics import RunMetrics, QuestionProfiler, combine_reports, save_run_report
+from dataset import merge_json_files
+from dedup import ParallelQuestionIndex, ImageIndex
+from classifier import SubjectClassifier, save_local_subjects, combine_subject_reports
+from export import export_dataset, EXPORT_EXTENSIONS
+from validation import validate_exam, validate_years, print_validation_summary, save_validation_report
 
 # ! =============== MAIN PARSING FUNCTIONS ===============
 
-def parse_gabarito(sample_gabarito):
-    # gather only part of table with answers
-    isolated_answers = sample_gabarito.split('c|c|}\n\\hline\n')[1].split(' \\\\\n\\hline')[:-1]
-    # isolate answer for each question + remove irrelevant latex symbols
-    individual_answers = []
-    individual_answers += sum([answer.split(' & ') for answer in isolated_answers], [])
-    individual_answers = [answer.replace('\\hline\n', '').replace('$', '') for answer in individual_answers]
-    # parse answers into dict with format {question_number: answer}
-    parsed_gabarito = {}
-    for answer in individual_answers:
-        question_number = int(answer.split('-')[0])
-        question_answer = answer.split('{')[1].replace('}', '')
-        parsed_gabarito[question_number] = question_answer
-    return parsed_gabarito
-
-def parse_prova(prova_dir, sample_prova, year, gabarito):
-    model = genai.GenerativeModel('models/gemini-1.5-flash-8b')
+def parse_prova(prova_dir, sample_prova, year, gabarito, concurrency=1, limiter=None, max_retries=5, cache=None, uploads=None,
+                subject_batch_size=1, checkpoint=None, image_workers=1, preprocessor=None, model=None, metrics=None,
+                profiler=None, image_index=None, subject_classifier=None):
+    # any backend from backends.py, Gemini by default
+    model = model or GeminiBackend()
+    metrics = metrics or RunMetrics()
+    profiler = profiler or QuestionProfiler(None)
     prova = []
-    sample_prova = apply_prefilter(sample_prova.split('\\begin{document}')[-1].replace('\n\n\n\\end{document}', ''))
-    isolated_questions = sample_prova.replace('QUESTAO', 'QUESTÃO')\
-        .replace('QUESTATO', 'QUESTÃO')\
-        .replace('QUESTȦO', 'QUESTÃO')\
-        .replace('QUESTÃ0', 'QUESTÃO')\
-        .replace('QUESTĀO', 'QUESTÃO')\
-        .replace('Questāo', 'QUESTÃO')\
-        .replace('Questão', 'QUESTÃO')\
-        .split('QUESTÃO')[1:]
-    potetial_support_text = sample_prova.replace('QUESTAO', 'QUESTÃO')\
-        .replace('QUESTATO', 'QUESTÃO')\
-        .replace('QUESTȦO', 'QUESTÃO')\
-        .replace('QUESTÃ0', 'QUESTÃO')\
-        .replace('QUESTĀO', 'QUESTÃO')\
-        .replace('Questāo', 'QUESTÃO')\
-        .replace('Questão', 'QUESTÃO')\
-        .split('QUESTÃO')[:1][0]
-    # print(potetial_support_text)
-    isolated_questions = remove_question_number_line(isolated_questions)
-    # making sure we have the right amount of questions, if not manually fix the .tex doc
-    if len(isolated_questions) != 90:
-        raise ValueError(f'Expected 90 questions, found {len(isolated_questions)}, fix this error before proceeding')
-    check_for_table(isolated_questions)
-    check_includegraphics_occurrences(isolated_questions)
-    check_alternatives_for_text_and_images(isolated_questions)
-    check_all_alternatives_present(isolated_questions)
-    check_support_text_present(isolated_questions)
+    # normalization (prefilter) + tokenization
+    with metrics.stage('segmentation'):
+        exam = ExamSegments(*exam_body(sample_prova))
+    # every rule is checked before any request is sent, if something is wrong manually fix the .tex doc
+    # (the issues are printed by main, which validates every year before parsing any)
+    with metrics.stage('validation'):
+        issues = validate_exam(exam, gabarito, year)
+    exam_errors = [issue for issue in issues if issue['severity'] == 'error']
+    if exam_errors:
+        problems = '; '.join(issue['message'] if issue['question'] is None else f"question {issue['question']}: {issue['message']}"
+                             for issue in exam_errors)
+        raise ValueError(f'{len(exam_errors)} problem(s) found in the exam, fix them before proceeding: {problems}')
+    # shared support text is kept as a (start, end) span of the normalized document
     support_text_limit_idx = 0
-    support_text = ''
-    if find_specific_sentence(potetial_support_text):
-        shared_question_intro = find_specific_sentence(potetial_support_text)[0]
-        isolated_questions[0] = isolated_questions[0].split(shared_question_intro)[0]  
-        support_text = potetial_support_text.split(shared_question_intro)[-1]
-        support_text_limit_idx = find_last_number(shared_question_intro, 0)
-
-    for idx, instance in tqdm(enumerate(isolated_questions)):
-        questao = {
-            'language': 'pt',
-            'country': 'Brazil',
-            'file_name': '',
-            'source' : '',
-            'license': 'Unknown',
-            'level' : 'University Entrance',
-            'category_en' : '',
-            'category_original_lang' : '',
-            'original_question_num' : -1,
-            'question' : '',
-            'options' : [],
-            'answer' : '',
-            'image_png' : '',
-            'image_information' : None,
-            'image_type' : None,
-            'parallel_question_id' : None
-        }
-        # Add shared support text to all questions individually
-        
-        if support_text_limit_idx > 0:
-            isolated_questions[idx] = support_text + instance
-            if support_text_limit_idx == (idx+1):
-                support_text_limit_idx = 0
-                support_text = ''
-        if find_specific_sentence(instance):
-            shared_question_intro = find_specific_sentence(instance)[0]
-            isolated_questions[idx] = instance.split(shared_question_intro)[0]  
-            support_text = instance.split(shared_question_intro)[-1]
-            support_text_limit_idx = find_last_number(shared_question_intro, idx+1)
-        # get question text and image
-        questao['question'], questao['image_png'] = separate_question_text_and_image(prova_dir, isolated_questions[idx], year, idx+1)
-        # get question alternatives + convert to 4-answer format
-        questao['original_question_num'] = idx+1
-        questao['file_name'] = f"{prova_dir}{year}_1fase_prova"
-        questao['source'] = SOURCE_DICT[year]
-        questao['options'], questao['answer'] = extract_options(isolated_questions[idx], gabarito[idx+1])
-        questao['options'] = parse_alternative_images(prova_dir, questao['options'], year, idx+1)
-        if idx < 20:
-            questao['category_original_lang'], questao['category_en'] = 'Língua Portuguesa', 'Portuguese Language'
-        elif idx < 30:
-            questao['category_original_lang'], questao['category_en'] = 'Inglês', 'English'
-        else:
-            questao['category_original_lang'], questao['category_en'] = prompt_gemini_subject(model, questao['question'])
-        if questao['image_png']:
-            questao['image_type'], questao['image_information'] = prompt_gemini_image(model, f"./{prova_dir}/{year}/new_images/{questao['image_png']}", questao['question'])
-        prova.append(questao)
+    support_span = None
+    if exam.intro:
+        support_span = (exam.intro[1], exam.preamble_end)
+        support_text_limit_idx = find_last_number(exam.text(*exam.intro), 0)
+
+    # Gemini requests are only collected here and sent afterwards by run_classification_jobs
+    jobs, finished = [], []
+    # {question index: local subject prediction} of the questions sent to Gemini
+    predictions = {}
+    stager = ImageStager(prova_dir, year, image_workers)
+    try:
+        for idx, question in enumerate(exam.questions):
+            with metrics.stage('parse', question=idx+1), profiler.profile(idx+1):
+                questao = {
+                    'language': 'pt',
+                    'country': 'Brazil',
+                    'file_name': '',
+                    'source' : '',
+                    'license': 'Unknown',
+                    'level' : 'University Entrance',
+                    'category_en' : '',
+                    'category_original_lang' : '',
+                    'original_question_num' : -1,
+                    'question' : '',
+                    'options' : [],
+                    'answer' : '',
+                    'image_png' : '',
+                    'image_information' : None,
+                    'image_type' : None,
+                    'parallel_question_id' : None
+                }
+                # Add shared support text to all questions individually
+                question_support = None
+                if support_text_limit_idx > 0:
+                    question_support = support_span
+                    if support_text_limit_idx == (idx+1):
+                        support_text_limit_idx = 0
+                        support_span = None
+                if question.intro:
+                    question_support = None
+                    support_span = (question.intro[1], question.end)
+                    support_text_limit_idx = find_last_number(exam.text(*question.intro), idx+1)
+                # get question text and image
+                questao['question'], questao['image_png'] = separate_question_text_and_image(stager, exam, question, question_support, idx+1)
+                # get question alternatives + convert to 4-answer format
+                questao['original_question_num'] = idx+1
+                questao['file_name'] = f"{prova_dir}{year}_1fase_prova"
+                questao['source'] = SOURCE_DICT[year]
+                questao['options'], questao['answer'] = extract_options(exam.alternatives(question), gabarito[idx+1])
+                questao['options'] = parse_alternative_images(stager, questao['options'], idx+1)
+                # questions finished in a previous (interrupted) run are taken from the checkpoint
+                if checkpoint is not None and checkpoint.restore(questao):
+                    prova.append(questao)
+                    continue
+                if idx < 20:
+                    questao['category_original_lang'], questao['category_en'] = 'Língua Portuguesa', 'Portuguese Language'
+                elif idx < 30:
+                    questao['category_original_lang'], questao['category_en'] = 'Inglês', 'English'
+                else:
+                    # confident local predictions skip the Gemini request
+                    subject, prediction = subject_classifier.classify(questao) if subject_classifier else (None, None)
+                    if subject is not None:
+                        questao['category_original_lang'], questao['category_en'] = subject
+                        if checkpoint is not None:
+                            checkpoint.local.add(idx+1)
+                    else:
+                        jobs.append(('subject', idx, (questao['question'],)))
+                        if prediction is not None:
+                            predictions[idx] = prediction
+                if questao['image_png']:
+                    jobs.append(('image', idx, (f"./{prova_dir}/{year}/new_images/{questao['image_png']}", questao['question'], None)))
+                # questions without Gemini requests are finished once their images are staged
+                if not jobs or jobs[-1][1] != idx:
+                    finished.append(questao)
+                prova.append(questao)
+        with metrics.stage('image_staging'):
+            stager.wait()
+    finally:
+        stager.close()
+    # near-identical images share the image type of their first classification, identical ones also share one file on disk
+    if image_index is not None:
+        with metrics.stage('image_dedup'):
+            image_groups = image_index.assign_all([os.path.join(stager.new_images_dir, filename) for filename in stager.used], image_workers)
+        jobs = group_image_jobs(jobs, image_groups, image_index)
+    # images are classified from downscaled copies, the dataset keeps the staged originals
+    if preprocessor is not None:
+        with metrics.stage('image_preprocessing'):
+            derivatives = preprocessor.prepare_all([args[0] for kind, _, args in jobs if kind != 'subject'], image_workers)
+        jobs = [(kind, idx, (derivatives[args[0]], *args[1:]) if kind != 'subject' else args) for kind, idx, args in jobs]
+    if checkpoint is not None:
+        for questao in finished:
+            checkpoint.record(questao)
 
+    with metrics.stage('classification'):
+        run_classification_jobs(model, prova, jobs, concurrency, limiter, max_retries, cache, uploads, subject_batch_size,
+                                checkpoint, metrics, profiler, image_index)
+    # agreement between the local classifier and Gemini on the questions that were sent anyway
+    for idx, prediction in predictions.items():
+        subject_classifier.record(prediction, prova[idx]['category_en'])
     return prova
 
-def merge_json_files(prova_dir):
-    merged_data = []
-    for year in os.listdir(prova_dir):
-        year_path = os.path.join(prova_dir, year)
-        if os.path.isdir(year_path):
-            with open(os.path.join(prova_dir, str(year), 'prova.json'), 'r') as file:
-                data = json.load(file)
-                print(type(data))
-                merged_data += data
-            src_images_dir = os.path.join(prova_dir, str(year), 'new_images/')
-            shutil.copytree(src_images_dir, os.path.join(prova_dir, 'images/'), dirs_exist_ok = True)
-
-    with open(os.path.join(prova_dir, 'data.json'), 'w') as outfile:
-        json.dump(merged_data, outfile)
+def group_image_jobs(jobs, image_groups, image_index):
+    """
+    Tags the image jobs with the group of their image. Images of a group that already has
+    an image type, or that is classified by an earlier job, become 'importance' jobs.
+    """
+    grouped, classified = [], set()
+    for kind, idx, args in jobs:
+        if kind == 'image':
+            group_id = image_groups[os.path.normpath(args[0])]
+            if group_id in classified or image_index.group_type(group_id) is not None:
+                kind = 'importance'
+            classified.add(group_id)
+            args = (args[0], args[1], group_id)
+        grouped.append((kind, idx, args))
+    return grouped
+
+def run_classification_jobs(model, prova, jobs, concurrency=1, limiter=None, max_retries=5, cache=None, uploads=None,
+                            subject_batch_size=1, checkpoint=None, metrics=None, profiler=None, image_index=None):
+    """
+    Sends the Gemini requests of an exam through a thread pool. Results are written
+    back by question index, so the exam keeps its order, and a request that still
+    fails after all retries only marks its own question as 'unknown'.
+    Requests whose content is already in `cache` are answered locally and images
+    are uploaded once through `uploads` before being classified. With
+    `subject_batch_size` > 1 subjects are classified in groups with a single
+    request each, and only the questions missing from the answer are sent alone.
+    Questions are appended to `checkpoint` as soon as all of their requests succeed.
+    Request time per question is added to `metrics` and the question selected in
+    `profiler` has its requests profiled. 'importance' jobs, of images whose group
+    in `image_index` is (or will be) classified, only ask for the image importance.
+    """
+    metrics = metrics or RunMetrics()
+    profiler = profiler or QuestionProfiler(None)
+
+    def with_retry(fn, *args):
+        return call_with_retry(fn, *args, limiter=limiter, max_retries=max_retries, metrics=metrics)
+
+    remaining = {}
+    for _, idx, _ in jobs:
+        remaining[idx] = remaining.get(idx, 0) + 1
+    failed = []
+    # {question index: image group} of the image jobs, see dedup.ImageIndex
+    image_groups = {idx: args[2] for kind, idx, args in jobs if kind != 'subject' and args[2] is not None}
+
+    def finish(kind, idx, result):
+        if kind == 'subject':
+            prova[idx]['category_original_lang'], prova[idx]['category_en'] = result
+        else:
+            prova[idx]['image_type'], prova[idx]['image_information'] = result
+            if kind == 'image' and idx in image_groups:
+                image_index.record_type(image_groups[idx], result[0])
+        remaining[idx] -= 1
+        if remaining[idx] == 0 and checkpoint is not None and all(question != idx+1 for _, question in failed):
+            checkpoint.record(prova[idx])
+
+    def cache_key(kind, args):
+        if kind == 'subject':
+            return cache.make_key(model.model_name, SUBJECT_PROMPT_TEMPLATE, args[0])
+        if kind == 'image':
+            return cache.make_key(model.model_name, IMAGE_PROMPT_TEMPLATE, args[1], args[0])
+        return cache.make_key(model.model_name, IMPORTANCE_PROMPT_TEMPLATE.format(image_type=args[2], question_text=''), args[1], args[0])
+
+    def resolve_importance(job):
+        """Importance job with the image type of its group, or a full image job if the group has none."""
+        kind, idx, (path, question_text, group_id) = job
+        image_type = image_index.group_type(group_id)
+        if image_type is None:
+            return 'image', idx, (path, question_text, group_id)
+        image_index.reused_types += 1
+        return 'importance', idx, (path, question_text, image_type)
+
+    def run_job(kind, args, key, handles):
+        if kind == 'subject':
+            result = with_retry(prompt_gemini_subject, model, *args)
+        elif kind == 'image':
+            result = with_retry(prompt_gemini_image, model, *args[:2], handles.get(args[0]))
+        else:
+            result = with_retry(prompt_gemini_importance, model, *args, handles.get(args[0]))
+        # unparseable answers are not cached so they get another chance on the next run
+        if cache is not None and 'unknown' not in result:
+            cache.put(key, kind, result)
+            if kind == 'image' and args[2] is not None:
+                # on the next run the group has an image type and this question becomes an importance job
+                cache.put(cache_key('importance', (args[0], args[1], result[0])), 'importance', result)
+        return result
+
+    def settle(kind, idx, args, key, handles=None):
+        start_time = time.perf_counter()
+        try:
+            with profiler.profile(idx+1):
+                return [((kind, idx), run_job(kind, args, key, handles or {}))]
+        except Exception as error:
+            print(f"Warning: {kind} classification failed for question {idx+1}: {error}")
+            failed.append((kind, idx+1))
+            return [((kind, idx), ('unknown', 'unknown') if kind != 'importance' else (args[2], 'unknown'))]
+        finally:
+            metrics.add_time(f'{kind}_request', time.perf_counter() - start_time, question=idx+1)
+
+    def settle_subject_batch(batch):
+        start_time = time.perf_counter()
+        try:
+            subjects = with_retry(prompt_gemini_subject_batch, model, [args[0] for _, _, args, _ in batch])
+        except Exception as error:
+            print(f"Warning: subject batch request failed ({error}), falling back to single requests")
+            subjects = [None] * len(batch)
+        # the batch request is shared evenly between its questions
+        for _, idx, _, _ in batch:
+            metrics.add_time('subject_batch_request', (time.perf_counter() - start_time) / len(batch), question=idx+1)
+        settled = []
+        for (kind, idx, args, key), subject in zip(batch, subjects):
+            if subject is None:
+                settled += settle(kind, idx, args, key)
+                continue
+            if cache is not None:
+                cache.put(key, kind, subject)
+            settled.append(((kind, idx), subject))
+        return settled
+
+    def run_jobs(jobs):
+        pending = []
+        for kind, idx, args in jobs:
+            key = None
+            if cache is not None:
+                key = cache_key(kind, args)
+                cached = cache.get(key)
+                if cached is None and kind == 'importance':
+                    # a full classification of the same image and question from an earlier run is just as good
+                    cached = cache.get(cache_key('image', args))
+                if cached is not None:
+                    finish(kind, idx, cached)
+                    continue
+            pending.append((kind, idx, args, key))
+
+        handles = {}
+        image_paths = [args[0] for kind, _, args, _ in pending if kind != 'subject']
+        if uploads is not None and image_paths:
+            with metrics.stage('uploads'):
+                handles = uploads.upload_all(image_paths, concurrency, with_retry)
+
+        tasks = []
+        subject_jobs = [job for job in pending if job[0] == 'subject']
+        if subject_batch_size > 1 and len(subject_jobs) > 1:
+            pending = [job for job in pending if job[0] != 'subject']
+            for start in range(0, len(subject_jobs), subject_batch_size):
+                tasks.append((settle_subject_batch, subject_jobs[start:start+subject_batch_size]))
+        tasks += [(settle, *job, handles) for job in pending]
+        if not tasks:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        try:
+            futures = [executor.submit(*task) for task in tasks]
+            # years that failed validation never reach the pool, so only the submitted ones are counted
+            for done, future in enumerate(tqdm(as_completed(futures), total=len(futures)), 1):
+                for (kind, idx), result in future.result():
+                    finish(kind, idx, result)
+        except BaseException:
+            # on Ctrl-C don't wait for the queued requests, finished questions are already checkpointed
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    # importance jobs whose group gets its image type from an image job of this exam run after it
+    deferred = [job for job in jobs if job[0] == 'importance' and image_index.group_type(job[2][2]) is None]
+    ready = [job for job in jobs if job not in deferred]
+    run_jobs([resolve_importance(job) if job[0] == 'importance' else job for job in ready])
+    if deferred:
+        run_jobs([resolve_importance(job) for job in deferred])
+    if failed:
+        print(f"Warning: classification failed for {len(failed)} request(s): {failed}")
+    return failed
+
+def process_year(args, year):
+    """
+    Parses a single exam year and writes its prova.json, returning a summary of the run.
+    Each call owns its model backend, cache connections and rate limiter so it
+    can run in a worker process (the requests-per-minute budget is split between workers).
+    """
+    start_time = time.time()
+    base_path = f'./{args.prova_dir}'
+    year_path = os.path.join(base_path, year)
+    with open(os.path.join(year_path, 'prova.tex'), 'r') as prova_file:
+        prova_content = prova_file.read()
+    with open(os.path.join(year_path, 'gabarito.tex'), 'r') as gabarito_file:
+        gabarito_content = gabarito_file.read()
+
+    metrics = RunMetrics()
+    model = InstrumentedBackend(make_backend(args.backend, args.fake_latency, args.fake_error_rate, args.fake_responses), metrics)
+    profiler = QuestionProfiler(args.profile_question) if args.profile_question else None
+    workers = max(1, args.workers)
+    limiter = RateLimiter(args.requests_per_minute / workers) if args.requests_per_minute > 0 else None
+    cache_path = args.cache_path or os.path.join(base_path, 'gemini_cache.sqlite')
+    cache = None
+    if not args.no_cache:
+        cache = ClassificationCache(cache_path, args.cache_max_entries, args.cache_max_age_days)
+    # handles of the fake backend are kept in memory so they never reach the real upload registry
+    uploads = UploadRegistry(cache_path if args.backend == 'gemini' else ':memory:', model.upload_file)
+
+    subject_classifier = None
+    if args.subject_threshold is not None:
+        subject_classifier = SubjectClassifier(args.subject_model or os.path.join(base_path, 'subject_model.sqlite'),
+                                               args.subject_threshold, args.subject_audit_rate)
+    image_index = None
+    if args.image_dedup_distance >= 0:
+        image_index = ImageIndex(args.image_index or os.path.join(base_path, 'image_index.sqlite'), model.model_name, args.image_dedup_distance)
+    checkpoint = Checkpoint(os.path.join(year_path, 'prova.checkpoint.jsonl'), args.resume)
+    preprocessor = None
+    if args.image_max_edge > 0:
+        preprocessor = ImagePreprocessor(args.image_max_edge, args.image_format, args.image_quality, args.image_colors)
+
+    failure = None
+    try:
+        print(f"Parsing data for year {year}...")
+        prova = parse_prova(args.prova_dir, prova_content, int(year), parse_gabarito(gabarito_content),
+                            args.concurrency, limiter, args.max_retries, cache, uploads, args.subject_batch_size,
+                            checkpoint, args.image_workers, preprocessor, model, metrics, profiler, image_index,
+                            subject_classifier)
+    except Exception as error:
+        failure = error
+    finally:
+        checkpoint.close()
+        if subject_classifier is not None:
+            subject_classifier.close()
+        if image_index is not None:
+            metrics.set_cache_stats('images', {'deduplicated': image_index.deduplicated, 'reused_types': image_index.reused_types})
+            image_index.close()
+        cache_stats = cache.stats() if cache is not None else {'hits': 0, 'misses': 0}
+        metrics.set_cache_stats('classification', cache_stats)
+        metrics.set_cache_stats('uploads', {'uploaded': uploads.uploaded, 'reused': uploads.reused})
+        if profiler is not None:
+            profiler.save(os.path.join(year_path, f'profile_q{args.profile_question}.prof'))
+        if cache is not None:
+            cache.close()
+        uploads.close()
+
+    # prova.json is only written once every question made it to the checkpoint
+    if failure is None:
+        missing = [questao['original_question_num'] for questao in prova if questao['original_question_num'] not in checkpoint.done]
+        if missing:
+            failure = ValueError(f'Questions {missing} could not be classified, rerun with --resume to retry only them')
+    if failure is not None:
+        # the latencies, errors and retries of failed years are the ones needed to size the quota, see write_run_report
+        failure.metrics = metrics.report()
+        raise failure
+    save_list_of_dicts_to_json(prova, os.path.join(year_path, 'prova.json'))
+    # questions labeled by the local classifier, in this run or in the interrupted one, are left out of its training
+    save_local_subjects(year_path, checkpoint.local)
+    checkpoint.remove()
+
+    return {
+        'year': year,
+        'questions': len(prova),
+        'unknown': sum('unknown' in (questao['category_en'], questao['image_type']) for questao in prova),
+        'seconds': time.time() - start_time,
+        'cache_hits': cache_stats['hits'],
+        'cache_misses': cache_stats['misses'],
+        'uploaded': uploads.uploaded,
+        'reused_uploads': uploads.reused,
+        'metrics': metrics.report(),
+        'subjects': subject_classifier.report() if subject_classifier else None,
+    }
+
+def print_summary(summaries, errors, elapsed):
+    print(f"\nProcessed {len(summaries)} year(s) in {elapsed:.1f}s")
+    for summary in sorted(summaries, key=lambda summary: summary['year']):
+        print(f"  {summary['year']}: {summary['questions']} questions, {summary['unknown']} unknown classification(s), {summary['seconds']:.1f}s")
+    for year, error in sorted(errors.items()):
+        print(f"  {year}: FAILED - {error}")
+    # requests of failed years were sent (and billed) too
+    reports = list(year_metrics(summaries, errors).values())
+    classification = [report['cache'].get('classification', {}) for report in reports]
+    hits = sum(stats.get('hits', 0) for stats in classification)
+    lookups = hits + sum(stats.get('misses', 0) for stats in classification)
+    print(f"Gemini cache: {hits} hits, {lookups - hits} misses ({hits / lookups if lookups else 0:.0%} hit rate)")
+    uploads = [report['cache'].get('uploads', {}) for report in reports]
+    print(f"Gemini uploads: {sum(stats.get('uploaded', 0) for stats in uploads)} uploaded, "
+          f"{sum(stats.get('reused', 0) for stats in uploads)} reused")
+    images = [report['cache'].get('images', {}) for report in reports]
+    print(f"Images: {sum(stats.get('deduplicated', 0) for stats in images)} identical copies stored as hardlinks, "
+          f"{sum(stats.get('reused_types', 0) for stats in images)} image type(s) reused")
+    subject_reports = [summary['subjects'] for summary in summaries if summary['subjects']]
+    if subject_reports:
+        subjects = combine_subject_reports(subject_reports)
+        print(f"Local subject classifier: {subjects['local']} labeled locally, {subjects['escalated']} uncertain and "
+              f"{subjects['audited']} audited sent to Gemini, agreement {subjects['agreed']}/{subjects['checked']}")
+        for bucket, entry in sorted(subjects['buckets'].items()):
+            print(f"  confidence {bucket}: {entry['agreed']}/{entry['checked']} agree with Gemini")
+    calls = combine_reports(reports)['calls']
+    for kind, entry in sorted(calls.items()):
+        errors_count = sum(entry['errors'].values())
+        print(f"  {kind}: {entry['calls']} call(s), {errors_count} error(s), {entry['latency_total']:.1f}s, {entry['total_tokens']} tokens")
+
+def year_metrics(summaries, errors):
+    """{year: metrics report} of the finished years and of the failed ones that got as far as sending requests."""
+    years = {summary['year']: summary['metrics'] for summary in summaries}
+    years.update({year: error.metrics for year, error in errors.items() if hasattr(error, 'metrics')})
+    return years
+
+def write_run_report(args, summaries, errors, run_metrics):
+    """Writes the timings, latencies and token usage of every year of this run, failed ones included, to --run_report."""
+    path = args.run_report or os.path.join(f'./{args.prova_dir}', 'run_report.json')
+    years = year_metrics(summaries, errors)
+    totals = combine_reports(list(years.values()) + [run_metrics.report()])
+    save_run_report(path, years, totals, vars(args), {year: str(error) for year, error in errors.items()})
+    print(f"Run report saved to {path}")
+
+def year_settings(args):
+    """Options that change the prova.json of a year, years built with other values are processed again."""
+    return {
+        'model': GEMINI_MODEL_NAME if args.backend == 'gemini' else args.backend,
+        # the contents of the canned responses, so editing the file rebuilds the years
+        'fake_responses': file_sha256(args.fake_responses) if args.backend == 'fake' and args.fake_responses else None,
+        'subject_threshold': args.subject_threshold,
+        'subject_audit_rate': args.subject_audit_rate if args.subject_threshold is not None else None,
+        'image_dedup_distance': args.image_dedup_distance,
+        'image_preprocessing': [args.image_max_edge, args.image_format, args.image_quality, args.image_colors] if args.image_max_edge > 0 else None,
+    }
+
+def merge_settings(args):
+    """Options that change the merged dataset, which is rebuilt when they differ from the last merge."""
+    return {'parallel_threshold': args.parallel_threshold, 'shard_size': args.shard_size}
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--prova_dir', help='Diretório em que as provas estão armazenadas seguindo a estrutura de pastas presente no README.')
+parser.add_argument('--concurrency', type=int, default=1, help='Número máximo de requisições simultâneas ao Gemini.')
+parser.add_argument('--requests_per_minute', type=float, default=0, help='Limite de requisições por minuto ao Gemini (0 desativa o limite).')
+parser.add_argument('--subject_batch_size', type=int, default=1, help='Número de questões classificadas por requisição de matéria ao Gemini (1 desativa o agrupamento).')
+parser.add_argument('--cache_path', help='Arquivo SQLite do cache de classificações do Gemini (padrão: <prova_dir>/gemini_cache.sqlite).')
+parser.add_argument('--no_cache', action='store_true', help='Desativa o cache de classificações do Gemini.')
+parser.add_argument('--cache_max_entries', type=int, default=0, help='Número máximo de entradas no cache (0 = sem limite).')
+parser.add_argument('--cache_max_age_days', type=float, default=0, help='Idade máxima, em dias, das entradas do cache (0 = sem limite).')
+parser.add_argument('--image_workers', type=int, default=4, help='Número de threads usadas para converter as imagens de cada ano.')
+parser.add_argument('--image_max_edge', type=int, default=1536, help='Maior lado, em pixels, das cópias das imagens enviadas ao Gemini (0 envia as imagens originais).')
+parser.add_argument('--image_format', default='webp', choices=['webp', 'jpeg', 'png'], help='Formato das cópias das imagens enviadas ao Gemini.')
+parser.add_argument('--image_quality', type=int, default=80, help='Qualidade de compressão (1-100) das cópias em WebP/JPEG.')
+parser.add_argument('--image_colors', type=int, default=0, help='Número de cores da paleta das cópias em PNG (0 mantém as cores originais).')
+parser.add_argument('--image_index', help='Arquivo SQLite do índice de hashes perceptuais das imagens (padrão: <prova_dir>/image_index.sqlite).')
+parser.add_argument('--image_dedup_distance', type=int, default=8, help='Distância de Hamming máxima (em 256 bits) entre imagens consideradas iguais (-1 desativa a deduplicação).')
+parser.add_argument('--shard_size', type=int, default=1000, help='Número de questões por shard JSONL do dataset final.')
+parser.add_argument('--parallel_index', help='Arquivo SQLite do índice de questões paralelas, que pode ser compartilhado entre vestibulares (padrão: <prova_dir>/parallel_index.sqlite).')
+parser.add_argument('--parallel_threshold', type=float, default=0.8, help='Similaridade mínima (Jaccard estimada por MinHash) entre questões paralelas (0 desativa a busca).')
+parser.add_argument('--export', choices=list(EXPORT_EXTENSIONS), help='Exporta também o dataset final em formato colunar (parquet ou arrow, requer pyarrow).')
+parser.add_argument('--embed_images', action='store_true', help='Inclui os bytes das imagens no arquivo exportado com --export.')
+parser.add_argument('--backend', default='gemini', choices=['gemini', 'fake'], help="Modelo usado nas classificações ('fake' simula o Gemini localmente, sem chave de API).")
+parser.add_argument('--fake_latency', type=float, default=0.0, help='Latência, em segundos, de cada requisição do backend fake.')
+parser.add_argument('--fake_error_rate', type=float, default=0.0, help='Fração das requisições do backend fake que falham com erro temporário.')
+parser.add_argument('--fake_responses', help='Arquivo JSON com respostas fixas do backend fake (chaves subject, subject_batch e image).')
+parser.add_argument('--subject_threshold', type=float, help='Confiança mínima (0-1) para usar a matéria prevista pelo classificador local em vez do Gemini (sem valor, o classificador local não é usado).')
+parser.add_argument('--subject_audit_rate', type=float, default=0.05, help='Fração das questões classificadas localmente que também é enviada ao Gemini para medir a concordância.')
+parser.add_argument('--subject_model', help='Arquivo SQLite do classificador local de matérias (padrão: <prova_dir>/subject_model.sqlite).')
+parser.add_argument('--workers', type=int, default=1, help='Número de processos usados para processar os anos em paralelo.')
+parser.add_argument('--resume', action='store_true', help='Retoma uma execução interrompida, pulando as questões já salvas no checkpoint de cada ano.')
+parser.add_argument('--force', action='store_true', help='Processa novamente todos os anos, mesmo os que não mudaram desde a última execução.')
+parser.add_argument('--run_report', help='Arquivo JSON com tempos por etapa, latências e uso de tokens da execução (padrão: <prova_dir>/run_report.json).')
+parser.add_argument('--profile_question', type=int, help='Número de uma questão a ser perfilada com cProfile (salvo em <ano>/profile_q<N>.prof).')
+parser.add_argument('--max_retries', type=int, default=5, help='Número de novas tentativas para erros de cota/temporários do Gemini.')
 
 def main() -> None:
     args = parser.parse_args()
     base_path = f'./{args.prova_dir}'
-    data = {}
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
-    genai.configure(api_key=gemini_api_key)
-
-    for year in tqdm(os.listdir(base_path)):
-        year_path = os.path.join(base_path, year)
-        if os.path.isdir(year_path):
-            prova_path = os.path.join(year_path, 'prova.tex')
-            gabarito_path = os.path.join(year_path, 'gabarito.tex')
-
-            if os.path.exists(prova_path) and os.path.exists(gabarito_path):
-                with open(prova_path, 'r') as prova_file:
-                    prova_content = prova_file.read()
-                with open(gabarito_path, 'r') as gabarito_file:
-                    gabarito_content = gabarito_file.read()
-                print(f"Parsing data for year {year}...")
-                data[year] = {
-                    'prova': parse_prova(args.prova_dir, prova_content, int(year), parse_gabarito(gabarito_content)),
-                    'gabarito': parse_gabarito(gabarito_content)
-                }
-                save_list_of_dicts_to_json(data[year]['prova'], f'./{args.prova_dir}/{year}/prova.json')
+    start_time = time.time()
+    manifest = BuildManifest(os.path.join(base_path, 'manifest.json'), PIPELINE_VERSION)
+    years = list_exam_years(base_path)
+    year_inputs, skipped = {}, []
+    settings = year_settings(args)
+    for year in years:
+        inputs = manifest.year_inputs(os.path.join(base_path, year), settings)
+        if not args.force and manifest.is_up_to_date(year, inputs, os.path.join(base_path, year, 'prova.json')):
+            skipped.append(year)
+        else:
+            year_inputs[year] = inputs
+    if skipped:
+        print(f"Skipping {len(skipped)} unchanged year(s): {skipped}")
+    summaries, errors = [], {}
+    # stages that run once for the whole dataset (the years have their own metrics)
+    run_metrics = RunMetrics()
+    # the local subject classifier learns from the subjects Gemini gave in the last merged dataset
+    if args.subject_threshold is not None:
+        subject_classifier = SubjectClassifier(args.subject_model or os.path.join(base_path, 'subject_model.sqlite'))
+        with run_metrics.stage('subject_training'):
+            retrained = subject_classifier.train(base_path)
+        print(f"Subject classifier: {retrained} year(s) (re)trained, {len(subject_classifier.labels)} subject(s) known")
+        subject_classifier.close()
+    # all years are validated up front, so every problem shows up in one report before any request is sent
+    with run_metrics.stage('validation'):
+        issues = validate_years(base_path, year_inputs)
+    if issues:
+        print_validation_summary(issues, list(year_inputs))
+        save_validation_report(issues, list(year_inputs), os.path.join(base_path, 'validation_report.json'))
+    for year in sorted({str(issue['year']) for issue in issues if issue['severity'] == 'error'}):
+        errors[year] = ValueError('invalid exam, see validation_report.json')
+        del year_inputs[year]
+
+    def on_year_finished(year, summary):
+        summaries.append(summary)
+        manifest.record_year(year, year_inputs[year], os.path.join(base_path, year, 'prova.json'), os.path.join(base_path, year, 'new_images'))
+        manifest.save()
+
+    if args.workers > 1:
+        # years are independent, each one is processed (and saved) by its own worker process
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(process_year, args, year): year for year in year_inputs}
+            # years that failed validation never reach the pool, so only the submitted ones are counted
+            for done, future in enumerate(tqdm(as_completed(futures), total=len(futures)), 1):
+                year = futures[future]
+                try:
+                    on_year_finished(year, future.result())
+                    print(f"Finished year {year} ({done}/{len(futures)})")
+                except Exception as error:
+                    errors[year] = error
+                    print(f"Error while processing year {year}: {error}")
+    else:
+        for year in tqdm(year_inputs):
+            try:
+                on_year_finished(year, process_year(args, year))
+            except Exception as error:
+                errors[year] = error
+                print(f"Error while processing year {year}: {error}")
 
-    merge_json_files(args.prova_dir)
+    print_summary(summaries, errors, time.time() - start_time)
+    if errors:
+        write_run_report(args, summaries, errors, run_metrics)
+        print("Fix the errors above before merging the dataset.")
+        raise SystemExit(1)
+    # the merged dataset is only rebuilt when the prova.json of some year or the merge options changed
+    outputs = manifest.outputs(years)
+    merged = args.force or manifest.needs_merge(outputs, os.path.join(base_path, 'data.json'), merge_settings(args))
+    if merged:
+        parallel_index = None
+        if args.parallel_threshold > 0:
+            parallel_index = ParallelQuestionIndex(args.parallel_index or os.path.join(base_path, 'parallel_index.sqlite'), args.parallel_threshold)
+        try:
+            with run_metrics.stage('merge'):
+                merge_json_files(args.prova_dir, args.shard_size, parallel_index)
+        finally:
+            if parallel_index is not None:
+                parallel_index.close()
+        manifest.record_merge(outputs, merge_settings(args))
+        manifest.save()
+    else:
+        print("Merged dataset is up to date.")
+    if args.export and (merged or not os.path.exists(os.path.join(base_path, f'data.{EXPORT_EXTENSIONS[args.export]}'))):
+        with run_metrics.stage('export'):
+            export_dataset(args.prova_dir, args.export, args.embed_images)
+    write_run_report(args, summaries, errors, run_metrics)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
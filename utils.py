@@ -1,8 +1,15 @@
 import os
 import json
 import re
-import google.generativeai as genai
-from PIL import Image
+import time
+import random
+import io
+import shutil
+import hashlib
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+# the Google client and PIL are imported where they are used, so offline tools like lint.py start quickly
 
 # ! =============== GLOBAL VARIABLES ===============
 
@@ -21,6 +28,21 @@ ALTERNATIVE_DICT = {
     'E' : 4
 }
 
+# bump whenever a change in the code changes the generated prova.json files,
+# so years that were already built are processed again (see BuildManifest)
+PIPELINE_VERSION = 1
+
+def retryable_errors():
+    """Errors raised by the Gemini API that are worth retrying (quota and transient server errors)."""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    )
+
 # ! =============== HELPER FUNCTIONS ===============
 
 def translate_subject(english_name):
@@ -37,12 +59,7 @@ def translate_subject(english_name):
     }
     return translations.get(english_name, "unknown")
 
-def prompt_gemini_image(model, img_path, question_text):
-    """Handles both image classification and importance assessment in a single request."""
-    # model = genai.GenerativeModel('models/gemini-1.5-flash-8B')
-    sample_file = genai.upload_file(path=img_path)
-
-    text = f"""You are an advanced image classification assistant. Your task is:
+IMAGE_PROMPT_TEMPLATE = """You are an advanced image classification assistant. Your task is:
     
     1. **Classify the image** into one of these categories:
        - 'graph': Data plotted on axes (line/bar charts, scatter plots, pie charts, flowcharts, etc.).
@@ -70,6 +87,60 @@ def prompt_gemini_image(model, img_path, question_text):
     {{essential or useful}}
     """
 
+# used when the category of the image is already known from a near-identical image (see dedup.ImageIndex)
+IMPORTANCE_PROMPT_TEMPLATE = """You are an advanced image analysis assistant. The image is a '{image_type}'. Your task is:
+
+    1. **Determine image importance** for answering this question:
+       - **Essential**: The question requires specific visual details from the image, it would be IMPOSSIBLE to answer the question without the image (i.e. only using the text).
+       - **Useful**: The image only provides extra context but is not necessary to answer the question.
+
+    The question:
+    {question_text}
+
+    Answer format:
+
+    Importance:
+    {{essential or useful}}
+    """
+
+SUBJECT_PROMPT_TEMPLATE = """You are a subject classification assistant. Your task is to determine:
+    
+    - The subject category of the question. Choose from: 
+      **History, Chemistry, Geography, Physics, Biology, Sociology, Philosophy, Mathematics and Art History.**
+
+    The question:
+    {question_text}
+
+    Answer format:
+
+    Subject:
+    {{subject option}}
+    """
+
+SUBJECT_BATCH_PROMPT_TEMPLATE = """You are a subject classification assistant. You will receive {count} numbered questions and your task is to determine, for each one of them:
+    
+    - The subject category of the question. Choose from: 
+      **History, Chemistry, Geography, Physics, Biology, Sociology, Philosophy, Mathematics and Art History.**
+
+    The questions:
+    {questions}
+
+    Answer format (a JSON list with exactly one object per question, in the same order):
+
+    [{{"question": 1, "subject": "{{subject option}}"}}, {{"question": 2, "subject": "{{subject option}}"}}, ...]
+    """
+
+def prompt_gemini_image(model, img_path, question_text, sample_file=None):
+    """
+    Handles both image classification and importance assessment in a single request.
+    `sample_file` can be a handle of an earlier upload of the same image (see UploadRegistry).
+    """
+    # model = genai.GenerativeModel('models/gemini-1.5-flash-8B')
+    if sample_file is None:
+        sample_file = model.upload_file(path=img_path)
+
+    text = IMAGE_PROMPT_TEMPLATE.format(question_text=question_text)
+
     response = model.generate_content([text, sample_file]).text
 
     # Extracting data from response
@@ -84,23 +155,25 @@ def prompt_gemini_image(model, img_path, question_text):
     
     return image_type, img_importance
 
-def prompt_gemini_subject(model, question_text):
-    """Handles subject classification independently of images."""
-    # model = genai.GenerativeModel('models/gemini-1.5-flash-8b')
+def prompt_gemini_importance(model, img_path, question_text, image_type, sample_file=None):
+    """Assesses only the importance of an image whose category is already known, returning both like prompt_gemini_image."""
+    if sample_file is None:
+        sample_file = model.upload_file(path=img_path)
 
-    text = f"""You are a subject classification assistant. Your task is to determine:
-    
-    - The subject category of the question. Choose from: 
-      **History, Chemistry, Geography, Physics, Biology, Sociology, Philosophy, Mathematics and Art History.**
+    text = IMPORTANCE_PROMPT_TEMPLATE.format(image_type=image_type, question_text=question_text)
 
-    The question:
-    {question_text}
+    response = model.generate_content([text, sample_file]).text
 
-    Answer format:
+    match = re.search(r'Importance:\s*(.+)', response)
+    img_importance = match.group(1).strip().lower() if match else "unknown"
 
-    Subject:
-    {{subject option}}
-    """
+    return image_type, img_importance
+
+def prompt_gemini_subject(model, question_text):
+    """Handles subject classification independently of images."""
+    # model = genai.GenerativeModel('models/gemini-1.5-flash-8b')
+
+    text = SUBJECT_PROMPT_TEMPLATE.format(question_text=question_text)
 
     response = model.generate_content(text).text
 
@@ -113,10 +186,40 @@ def prompt_gemini_subject(model, question_text):
 
     return  subject_pt, subject_en
 
-def find_specific_sentence(text):
-    pattern = r'\bLeia\b.*?responder às questões.*?\.'
-    matches = re.findall(pattern, text, re.IGNORECASE)
-    return matches
+def prompt_gemini_subject_batch(model, question_texts):
+    """
+    Classifies the subject of several questions in a single request.
+    Returns one (subject_pt, subject_en) tuple per question, or None for the
+    questions whose answer could not be parsed.
+    """
+    questions = '\n\n'.join(f"Question {number}:\n{text}" for number, text in enumerate(question_texts, 1))
+    text = SUBJECT_BATCH_PROMPT_TEMPLATE.format(count=len(question_texts), questions=questions)
+
+    response = model.generate_content(text, generation_config={'response_mime_type': 'application/json'}).text
+
+    return parse_subject_batch_response(response, len(question_texts))
+
+def parse_subject_batch_response(response, count):
+    subjects = [None] * count
+    match = re.search(r'\[.*\]', response, re.DOTALL)
+    if not match:
+        return subjects
+    try:
+        answers = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return subjects
+    for answer in answers:
+        if not isinstance(answer, dict) or not isinstance(answer.get('subject'), str):
+            continue
+        try:
+            number = int(answer.get('question'))
+        except (TypeError, ValueError):
+            continue
+        subject_en = answer['subject'].strip()
+        # subjects outside the list are retried with a single-question request
+        if 1 <= number <= count and translate_subject(subject_en) != 'unknown':
+            subjects[number-1] = (translate_subject(subject_en), subject_en)
+    return subjects
 
 def convert_list_elements_to_int(lst):
     return [int(element) for element in lst]
@@ -172,59 +275,7 @@ def remove_question_number_line(questions):
     return [text.split('\n', 1)[-1] for text in questions]
 
 def apply_prefilter(text):
-    text = remove_font_markers(text)
-    text = remove_section_tags(text)
-    text = fix_itemize(text)
-    text = fix_enumerate(text)
-    text = fix_center(text)
-    text = remove_latex_breaklines(text)
-    text = fix_hyphen(text)
-    text = fix_ordinals(text)
-    return text
-
-def check_for_table(questions):
-    """
-    Check which questions (if any) have latex table in them,
-    which should be replaced by images.
-    """
-    questions_to_fix = []
-    for idx, question in enumerate(questions, 1):
-        pattern = r'\\begin{tabular}'
-        matches = re.findall(pattern, question)
-        if matches:
-            questions_to_fix.append(idx)
-    if questions_to_fix:
-        print(f"Questions with tables (need to be fixed): {questions_to_fix}")
-        raise ValueError('Questions with tables found, fix this error before proceeding')
-
-def check_includegraphics_occurrences(questions):
-    """
-    Check which questions (if any) have more than one image.
-    """
-    questions_to_fix = []
-    for idx, question in enumerate(questions, 1):
-        pattern = r'\\includegraphics'
-        matches = re.findall(pattern, question.split('(A)')[0])
-        if len(matches) > 1:
-            questions_to_fix.append(idx)
-    if questions_to_fix:
-        print(f"Questions with more than one image (need to be fixed): {questions_to_fix}")
-        raise ValueError('Questions with more than one image, fix this error before proceeding')
-
-def check_alternatives_for_text_and_images(questions):
-    """
-    Check which questions (if any) have both images and text in the alternatives.
-    """
-    questions_to_fix = []
-    for idx, question in enumerate(questions, 1):
-        # pattern = r'\\includegraphics.*?\}'
-        pattern = r'(?<!\\)\b\w+.*?\\includegraphics.*?\}'
-        matches = re.findall(pattern, question.split('(A)')[-1].split('(B)')[0], re.DOTALL)
-        if len(matches) >= 1:
-            questions_to_fix.append(idx)
-    if questions_to_fix:
-        print(f"Questions both images and text in the alternatives: {questions_to_fix}")
-        raise ValueError('Questions w/ both images and text in the alternatives, fix this error before proceeding')
+    return PREFILTER_NORMALIZER(text)
 
 def extract_alternatives_content(text):
     pattern = r'\((A|B|C|D|E)\)\s*(.*?)\s*(?=\(A\)|\(B\)|\(C\)|\(D\)|\(E\)|$)'
@@ -237,30 +288,36 @@ def find_part_starting_with_E(text):
     matches = re.findall(pattern, text, re.DOTALL)
     return matches
 
-def parse_alternative_images(prova_dir, options, year, question_number):
+def source_image_filename(directive):
+    """File in <year>/images referenced by an \\includegraphics directive."""
+    image_filename = extract_filename_from_includegraphics(directive)[0]
+    return f"{image_filename}.jpg" if image_filename[:4] == '2025' else f"{image_filename}.png"
+
+def parse_alternative_images(stager, options, question_number):
     if find_includegraphics_string(options[0]):
         for idx, option in enumerate(options):
-            image_filename = extract_filename_from_includegraphics(option)[0]
-            image_filename = f"{image_filename}.jpg" if image_filename[:4] == '2025' else f"{image_filename}.png" 
-            image_filename = process_image(prova_dir, os.path.join(prova_dir, f'/{year}/images/{image_filename}'), year, question_number)
-            options[idx] = image_filename
+            options[idx] = stager.stage(source_image_filename(option), question_number)
     return options
 
 
-def separate_question_text_and_image(prova_dir, question, year, question_number):
+def separate_question_text_and_image(stager, exam, question, support_span, question_number):
+    """
+    Builds the question text (shared support text + stem) from the offsets in `exam`
+    and stages its image, if any.
+    """
     image_filename = None
-    question = question.split('(A)')[0].strip()
-    image = find_includegraphics_string(question)
+    image = exam.first_includegraphics(*support_span) if support_span else None
+    image = image or exam.first_includegraphics(question.start, question.stem_end)
+    stem = exam.text(question.start, question.stem_end)
+    question = (exam.text(*support_span) + stem if support_span else stem).strip()
     if image:
-        question = question.replace(image[0], '')
-        image_filename = extract_filename_from_includegraphics(image[0])[0]
-        image_filename = f"{image_filename}.jpg" if image_filename[:4] == '2025' else f"{image_filename}.png" 
-        image_filename = process_image(prova_dir, os.path.join(prova_dir, f'/{year}/images/{image_filename}'), year, question_number)
+        question = question.replace(image, '')
+        image_filename = stager.stage(source_image_filename(image), question_number)
     return question, image_filename
 
 
-def extract_options(question, answer):
-    options = list(extract_alternatives_content(question).values())
+def extract_options(alternatives, answer):
+    options = list(alternatives.values())
     if answer != 'E':
         options = options[:-1]
         answer = ALTERNATIVE_DICT[answer]
@@ -279,85 +336,638 @@ def find_includegraphics_string(text):
     matches = re.findall(pattern, text, re.DOTALL)
     return matches 
 
-def is_file_in_dir(dir_list, filename):
-    for existing_file in dir_list:
-        if filename in existing_file:
-            print(filename)
-            return existing_file
-    return False
-
-from PIL import Image
-
-def process_image(prova_dir, image_path, year, question_number):
-    # Ensure the new_images directory exists
-    test_name = prova_dir.split('/')[-1].lower()
-    new_images_dir = os.path.join(prova_dir, f'/{year}/new_images')
-    os.makedirs(new_images_dir, exist_ok=True)
-    dir_list = os.listdir(new_images_dir)
-    # Extract the directory, filename, and extension
-    directory, filename = os.path.split(image_path)
-    name, ext = os.path.splitext(filename)
-    file_exists = is_file_in_dir(dir_list, f"{name}.png")
-    if file_exists:
-        return file_exists
-    else:
-        # Check the extension and modify the filename accordingly
-        if ext.lower() == '.jpg':
-            new_filename = f"{test_name}_{year}_{question_number}_{name}.png"
-        elif ext.lower() == '.png':
-            if not name.startswith(f"{test_name}_{year}_"):
-                new_filename = f"{test_name}_{year}_{question_number}_{name}.png"
-            else:
-                new_filename = filename
-        else:
-            raise ValueError("Unsupported file extension. Only .png and .jpg are allowed.")
-        
-        # Define the new image path
-        new_image_path = os.path.join(new_images_dir, new_filename)
-        # Move and rename the image
-        img = Image.open(image_path)
-        img.save(new_image_path)
-
-        return new_filename
-
-def check_all_alternatives_present(questions):
-    """
-    Check which questions (if any) have latex table in them,
-    which should be replaced by images.
-    """
-    alternatives = ['(A)', '(B)', '(C)', '(D)', '(E)']
-    questions_to_fix = []
-    for idx, question in enumerate(questions, 1):
-        for alternative in alternatives:
-            if alternative not in question:
-                questions_to_fix.append(idx)
-    if questions_to_fix:
-        print(f"Questions alternative text irregularities: {questions_to_fix}")
-        raise ValueError('Questions with alternative text irregularities, fix this error before proceeding')
-
-def check_text_after_alternative_e(text):
-    pattern = r'\(E\).*?\n(.*)'
-    match = re.search(pattern, text, re.DOTALL)
-    return match
-
-def check_support_text_present(questions):
-    """
-    Check which questions (if any) have more than one image.
-    """
-    questions_to_fix = []
-    for idx, question in enumerate(questions, 1):
-        match = check_text_after_alternative_e(question)
-        # print(match.group(1).strip())
-        # quit(1)
-        if match and match.group(1).strip():
-            questions_to_fix.append(idx)
-    if questions_to_fix:
-        print(f"Warning: potential questions with support text (might need to be fixed): {questions_to_fix}")
-        print(f"If support text is indeed present make sure it starts with 'Leia', otherwise leave it as is.")
-
 def save_list_of_dicts_to_json(list_of_dicts, filename):
     with open(filename, 'w') as json_file:
         json.dump(list_of_dicts, json_file, indent=4)
 
 def remove_font_markers(text):
-    return text.replace('[0pt]', '')
\ No newline at end of file
+    return text.replace('[0pt]', '')
+
+# ! =============== REQUEST SCHEDULING ===============
+
+class RateLimiter:
+    """
+    Token bucket shared by all threads that send requests to Gemini.
+    Tokens refill at `requests_per_minute / 60` per second and at most
+    `burst` requests can be sent back to back.
+    """
+    def __init__(self, requests_per_minute, burst=1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+def call_with_retry(fn, *args, limiter=None, max_retries=5, base_delay=2.0, max_delay=60.0, metrics=None, **kwargs):
+    """
+    Calls `fn` respecting the rate limiter, retrying quota/transient errors
+    with exponential backoff (plus jitter so concurrent threads don't retry in sync).
+    Retries and rate limiter waits are counted in `metrics` (see metrics.RunMetrics).
+    """
+    retryable = retryable_errors()
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            wait_start = time.perf_counter()
+            limiter.acquire()
+            if metrics is not None:
+                metrics.record_rate_limit_wait(time.perf_counter() - wait_start)
+        try:
+            return fn(*args, **kwargs)
+        except retryable as error:
+            if attempt == max_retries:
+                raise
+            if metrics is not None:
+                metrics.record_retry(fn.__name__)
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"Warning: {error.__class__.__name__} from Gemini, retrying in {delay:.1f}s ({attempt+1}/{max_retries})")
+            time.sleep(delay)
+
+# ! =============== CHECKPOINTING ===============
+
+# fields of a question that come from Gemini, the only ones taken from the checkpoint on --resume
+CHECKPOINT_FIELDS = ('category_en', 'category_original_lang', 'image_type', 'image_information')
+
+class Checkpoint:
+    """
+    Append-only JSONL file with the questions of an exam that are already finished,
+    so a crash or quota error doesn't throw away the Gemini answers obtained so far.
+    `local` holds the questions whose subject came from the local classifier, saved
+    with them so they stay out of its training after a resume.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.local = set()
+        self.done = self.load() if resume else {}
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        # a crash in the middle of a write leaves an incomplete last line behind
+        if self.file.tell() > 0:
+            with open(path, 'rb') as existing_file:
+                existing_file.seek(-1, os.SEEK_END)
+                if existing_file.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def load(self):
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'r', encoding='utf-8') as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    questao = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[questao['original_question_num']] = questao
+                if questao.pop('labeled_locally', False):
+                    self.local.add(questao['original_question_num'])
+        return done
+
+    def restore(self, questao):
+        """
+        Copies the Gemini classification of `questao` from the checkpoint if the text, options and
+        image it was classified from didn't change. The other fields (answer, source...) are always
+        the freshly parsed ones, so fixes to gabarito.tex made before resuming are kept.
+        """
+        checkpointed = self.done.get(questao['original_question_num'])
+        if checkpointed is None or any(checkpointed[field] != questao[field] for field in ('question', 'options', 'image_png')):
+            # classified again in this run, so it only counts as done once it is recorded again
+            self.done.pop(questao['original_question_num'], None)
+            self.local.discard(questao['original_question_num'])
+            return False
+        for field in CHECKPOINT_FIELDS:
+            questao[field] = checkpointed[field]
+        return True
+
+    def record(self, questao):
+        record = dict(questao, labeled_locally=True) if questao['original_question_num'] in self.local else questao
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.done[questao['original_question_num']] = questao
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        if not self.file.closed:
+            self.close()
+        os.remove(self.path)
+
+# ! =============== TEXT NORMALIZATION ===============
+
+class TextNormalizer:
+    """
+    Applies a list of (regex, replacement) substitution rules to a text in one scan.
+    Rules are compiled into a single alternation and each match is dispatched to the
+    rule that produced it: literal rules through a table keyed by the matched text, the
+    other rules by matching their own pattern at the same span (the first rule wins).
+    A replacement is a string (which may use the rule's own groups, e.g. r'\\1º') or a
+    function called with the rule's match and the normalizer itself.
+
+    `re` only scans fast when it can skip straight to the characters a match may start
+    with, so literal rules are anchored at their first non-blank character (the blanks
+    are checked when dispatching) and rules that start with a character class, like
+    r'(\\d)[o@]', run afterwards as separate passes, in order.
+    """
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.compile()
+
+    def add_rule(self, pattern, replacement):
+        """Adds a new substitution, e.g. another OCR variant of the question marker."""
+        self.rules.append((pattern, replacement))
+        self.compile()
+
+    def compile(self):
+        self.literals = {}
+        self.regex_rules = []
+        self.extra_passes = []
+        fused_patterns = []
+        for idx, (pattern, replacement) in enumerate(self.rules):
+            rule_pattern = re.compile(pattern)
+            if callable(replacement):
+                handler = self._callable_handler(replacement)
+            elif rule_pattern.groups:
+                handler = self._template_handler(replacement)
+            else:
+                handler = replacement
+            literal = re.sub(r'\\(.)', r'\1', pattern, flags=re.DOTALL)
+            if re.escape(literal) == pattern and literal.strip():
+                anchor = literal.lstrip()
+                prefix = literal[:len(literal) - len(anchor)]
+                # groups or lookarounds in front of the alternatives also keep `re` from skipping ahead
+                if anchor not in self.literals:
+                    fused_patterns.append(re.escape(anchor))
+                self.literals.setdefault(anchor, []).append((idx, prefix, handler))
+            elif starts_with_literal(pattern):
+                # alternatives inside a group are not scanned for either, and since every
+                # rule becomes one more alternative of the same alternation none is needed
+                fused_patterns.append(pattern)
+                self.regex_rules.append((idx, rule_pattern, handler))
+            else:
+                self.extra_passes.append((rule_pattern, handler if callable(replacement) else replacement))
+        self.pattern = re.compile('|'.join(fused_patterns)) if fused_patterns else None
+        # literals that no earlier regex rule can match are replaced without going through dispatch
+        self.fast_literals = {}
+        for anchor, candidates in self.literals.items():
+            idx, prefix, handler = candidates[0]
+            shadowed = any(rule_idx < idx and rule_pattern.fullmatch(anchor) for rule_idx, rule_pattern, _ in self.regex_rules)
+            if not prefix and handler.__class__ is str and not shadowed:
+                self.fast_literals[anchor] = handler
+
+    def _callable_handler(self, replacement):
+        return lambda rule_match: replacement(rule_match, self)
+
+    def _template_handler(self, replacement):
+        return lambda rule_match: rule_match.expand(replacement)
+
+    def dispatch(self, match):
+        """Returns (replacement, number of blank characters before the match it also replaces)."""
+        text, start = match.string, match.start()
+        # an anchor whose blanks are missing is left as it is
+        literal_idx, literal_prefix, literal_handler = len(self.rules), '', match.group()
+        for idx, prefix, handler in self.literals.get(match.group(), ()):
+            if text.startswith(prefix, start - len(prefix)):
+                literal_idx, literal_prefix, literal_handler = idx, prefix, handler
+                break
+        for idx, rule_pattern, handler in self.regex_rules:
+            if idx > literal_idx:
+                break
+            rule_match = rule_pattern.fullmatch(text, start, match.end())
+            if rule_match:
+                return (handler if handler.__class__ is str else handler(rule_match)), 0
+        return literal_handler, len(literal_prefix)
+
+    def __call__(self, text):
+        if self.pattern is not None:
+            pieces = []
+            last = 0
+            fast_literals = self.fast_literals
+            for match in self.pattern.finditer(text):
+                replacement = fast_literals.get(match.group())
+                if replacement is not None:
+                    start = match.start()
+                else:
+                    replacement, prefix_len = self.dispatch(match)
+                    start = match.start() - prefix_len
+                # the blanks before this match were already consumed by the previous one
+                if start < last:
+                    continue
+                pieces.append(text[last:start])
+                pieces.append(replacement)
+                last = match.end()
+            pieces.append(text[last:])
+            text = ''.join(pieces)
+        for rule_pattern, replacement in self.extra_passes:
+            text = rule_pattern.sub(replacement, text)
+        return text
+
+def starts_with_literal(pattern):
+    if not pattern or pattern[0] in '()[].^$|' or pattern[0].isspace():
+        return False
+    return pattern[0] != '\\' or (len(pattern) > 1 and not pattern[1].isalnum())
+
+# the same substitutions made by the fix_* / remove_* helpers above
+PREFILTER_RULES = [
+    # LaTeX line break with spacing, removing [0pt] first turns it into a plain line break below
+    (re.escape('\\\\[0pt]\n'), '\n'),
+    (re.escape('[0pt]'), ''),
+    # the content of the section title goes through the other rules as well
+    (r'\\section\*\{(.*?)\}', lambda match, normalizer: normalizer(match.group(1))),
+    (re.escape('\\begin{itemize}'), ''),
+    (re.escape('\\end{itemize}'), ''),
+    (re.escape('  \\item'), '-'),
+    (re.escape('\\begin{enumerate}'), ''),
+    (re.escape('\\end{enumerate}'), ''),
+    (re.escape('\\begin{center}'), ''),
+    (re.escape('\\end{center}'), ''),
+    (re.escape('\\\\\n'), '\n'),
+    (re.escape('--'), '-'),
+    # same as fix_ordinals, written with one alternative per digit instead of r'(\d)[o@응ㅇ]'
+    # so it is scanned together with the other rules (see TextNormalizer)
+    ('|'.join(f'{digit}[o@응ㅇ]' for digit in '0123456789'), lambda match, normalizer: f'{match.group()[0]}º'),
+]
+
+# OCR misreadings of the "QUESTÃO" header that starts every question
+QUESTION_MARKER_VARIANTS = ['QUESTAO', 'QUESTATO', 'QUESTȦO', 'QUESTÃ0', 'QUESTĀO', 'Questāo', 'Questão']
+QUESTION_MARKER_RULES = [(re.escape(variant), 'QUESTÃO') for variant in QUESTION_MARKER_VARIANTS]
+
+PREFILTER_NORMALIZER = TextNormalizer(PREFILTER_RULES)
+# used on whole exams: prefilter + question markers in one pass
+DOCUMENT_NORMALIZER = TextNormalizer(PREFILTER_RULES + QUESTION_MARKER_RULES)
+
+def split_exam(document):
+    """
+    Normalizes the body of an exam and splits it into the text before the
+    first question (potential support text) and the list of questions.
+    """
+    parts = DOCUMENT_NORMALIZER(document).split('QUESTÃO')
+    return parts[0], parts[1:]
+
+# ! =============== EXAM SEGMENTATION ===============
+
+def parse_gabarito(sample_gabarito):
+    # gather only part of table with answers
+    isolated_answers = sample_gabarito.split('c|c|}\n\\hline\n')[1].split(' \\\\\n\\hline')[:-1]
+    # isolate answer for each question + remove irrelevant latex symbols
+    individual_answers = []
+    individual_answers += sum([answer.split(' & ') for answer in isolated_answers], [])
+    individual_answers = [answer.replace('\\hline\n', '').replace('$', '') for answer in individual_answers]
+    # parse answers into dict with format {question_number: answer}
+    parsed_gabarito = {}
+    for answer in individual_answers:
+        question_number = int(answer.split('-')[0])
+        question_answer = answer.split('{')[1].replace('}', '')
+        parsed_gabarito[question_number] = question_answer
+    return parsed_gabarito
+
+def exam_body(prova_tex):
+    """
+    Body of an exam .tex (between \\begin{document} and \\end{document}) and the
+    line of the original file it starts on.
+    """
+    head, _, body = prova_tex.rpartition('\\begin{document}')
+    return body.replace('\n\n\n\\end{document}', ''), head.count('\n') + 1
+
+def list_exam_years(base_path):
+    """Year directories that have both a prova.tex and a gabarito.tex."""
+    years = []
+    for year in sorted(os.listdir(base_path)):
+        year_path = os.path.join(base_path, year)
+        if os.path.exists(os.path.join(year_path, 'prova.tex')) and os.path.exists(os.path.join(year_path, 'gabarito.tex')):
+            years.append(year)
+    return years
+
+# every structural token the later stages care about, found in a single scan of the exam
+SEGMENT_TOKEN_PATTERN = re.compile(r'QUESTÃO|\([A-E]\)|\\includegraphics|\\begin\{tabular\}')
+# "Leia ... para responder às questões ..." support text intros are found in a second pass: a pattern
+# starting with a literal lets re jump between occurrences, while "[Ll]..." (or an alternation starting
+# with it) is tried at every "l" of the text, which made the single combined scan slower than two passes
+INTRO_CANDIDATE_PATTERNS = (re.compile(r'eia\b'), re.compile(r'EIA\b'))
+INTRO_PATTERN = re.compile(r'leia\b.*?responder às questões.*?\.', re.IGNORECASE)
+INCLUDEGRAPHICS_PATTERN = re.compile(r'\\includegraphics.*?\{.*?\}', re.DOTALL)
+NON_BLANK_PATTERN = re.compile(r'\S')
+
+class QuestionSegment:
+    """Offsets of the parts of a question inside the normalized exam text (see ExamSegments)."""
+    __slots__ = ('number', 'start', 'end', 'alternatives', 'images', 'tables', 'intro')
+
+    def __init__(self, number, start, end):
+        self.number = number
+        self.start = start              # first character after the line with the question number
+        self.end = end                  # start of the next question
+        self.alternatives = []          # (letter, position of the "(X)" marker), in order of appearance
+        self.images = []                # positions of \includegraphics
+        self.tables = []                # positions of \begin{tabular}
+        self.intro = None               # (start, end) of the "Leia ... responder às questões ..." sentence
+
+    def first_alternative(self, letter):
+        """Position of the first "(X)" marker of `letter`, or None."""
+        for marker_letter, position in self.alternatives:
+            if marker_letter == letter:
+                return position
+        return None
+
+    @property
+    def own_end(self):
+        """End of the question itself, the text after a shared support intro belongs to the next questions."""
+        return self.intro[0] if self.intro else self.end
+
+    @property
+    def stem_end(self):
+        for letter, position in self.alternatives:
+            if letter == 'A' and position < self.own_end:
+                return position
+        return self.own_end
+
+class ExamSegments:
+    """
+    Index of an exam built with one normalization pass and one tokenization pass:
+    the normalized text plus, for each question, the offsets of its stem, image
+    directives, tables, alternatives and shared support text intro. Later stages
+    read these offsets instead of splitting the question strings again.
+    """
+    def __init__(self, document, first_line=1):
+        self.document = DOCUMENT_NORMALIZER(document)
+        self.first_line = first_line
+        self.preamble_end = len(self.document)
+        self.intro = None
+        self.questions = []
+        # positions of the QUESTÃO markers
+        markers = []
+        current = None
+        for match in SEGMENT_TOKEN_PATTERN.finditer(self.document):
+            token, position = match.group(), match.start()
+            if token == 'QUESTÃO':
+                if current is None:
+                    self.preamble_end = position
+                else:
+                    current.end = position
+                # the rest of the line is the question number
+                line_end = self.document.find('\n', match.end())
+                start = line_end + 1 if line_end != -1 else match.end()
+                current = QuestionSegment(len(self.questions) + 1, start, len(self.document))
+                self.questions.append(current)
+                markers.append(position)
+            elif current is not None and position < current.start:
+                continue
+            elif token[0] == '(':
+                if current is not None:
+                    current.alternatives.append((token[1], position))
+            elif token == '\\includegraphics':
+                if current is not None:
+                    current.images.append(position)
+            elif current is not None:
+                current.tables.append(position)
+        for span in self.find_intros():
+            idx = bisect.bisect_right(markers, span[0]) - 1
+            if idx < 0:
+                self.intro = self.intro or span
+            elif span[0] >= self.questions[idx].start and self.questions[idx].intro is None:
+                self.questions[idx].intro = span
+        # a question line without line break is still cut at the next question
+        for question in self.questions:
+            question.start = min(question.start, question.end)
+
+    def find_intros(self):
+        """(start, end) of the support text intros, in order."""
+        spans = []
+        for pattern in INTRO_CANDIDATE_PATTERNS:
+            for match in pattern.finditer(self.document):
+                start = match.start() - 1
+                if start < 0 or self.document[start] not in 'Ll':
+                    continue
+                # "Leia" in the middle of a word, as in "Releia"
+                if start and (self.document[start - 1].isalnum() or self.document[start - 1] == '_'):
+                    continue
+                intro = INTRO_PATTERN.match(self.document, start)
+                if intro:
+                    spans.append(intro.span())
+        return sorted(spans)
+
+    def text(self, start, end):
+        return self.document[start:end]
+
+    def line(self, position):
+        """Line of the original .tex file, normalization never adds or removes line breaks."""
+        return self.first_line + self.document.count('\n', 0, position)
+
+    def alternatives(self, question):
+        """{letter: text} of the alternatives, each one running until the next alternative marker."""
+        markers = [(letter, position) for letter, position in question.alternatives if position < question.own_end]
+        contents = {}
+        for idx, (letter, position) in enumerate(markers):
+            content_end = markers[idx + 1][1] if idx + 1 < len(markers) else question.own_end
+            contents[letter] = self.document[position + 3:content_end].strip()
+        return contents
+
+    def first_includegraphics(self, start, end):
+        """First full \\includegraphics{...} directive between `start` and `end`."""
+        position = self.document.find('\\includegraphics', start, end)
+        if position == -1:
+            return None
+        match = INCLUDEGRAPHICS_PATTERN.match(self.document, position, end)
+        return match.group() if match else None
+
+# ! =============== IMAGE STAGING ===============
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+class ImageStager:
+    """
+    Copies the images used by an exam from <year>/images to <year>/new_images, named
+    "<test>_<year>_<question>_<name>.png". The staged files are indexed once per year,
+    sources that already are PNGs are hardlinked (or copied) and only the others are
+    decoded and saved as PNG, in a thread pool. Identical sources are converted once.
+    The size and mtime of the source of each staged file are kept in <year>/staged_images.json,
+    so a file staged by an earlier run is only reused while its source is unchanged.
+    `stage` returns the final filename right away, call `wait` before reading the files.
+    """
+    def __init__(self, prova_dir, year, max_workers=1):
+        test_name = prova_dir.split('/')[-1].lower()
+        self.prefix = f"{test_name}_{year}_"
+        self.images_dir = os.path.join(prova_dir, str(year), 'images')
+        self.new_images_dir = os.path.join(prova_dir, str(year), 'new_images')
+        os.makedirs(self.new_images_dir, exist_ok=True)
+        # {staged filename: [source filename, size, mtime_ns]}
+        self.sources_path = os.path.join(prova_dir, str(year), 'staged_images.json')
+        self.sources = {}
+        if os.path.exists(self.sources_path):
+            with open(self.sources_path, 'r') as sources_file:
+                self.sources = json.load(sources_file)
+        # {source name with .png extension: staged filename}
+        self.staged = {}
+        for filename in sorted(os.listdir(self.new_images_dir)):
+            if filename.endswith('.png'):
+                self.staged.setdefault(filename, filename)
+                self.staged.setdefault(self.source_key(filename), filename)
+        # {sha256 of a source image: future with the path it was staged to}
+        self.by_hash = {}
+        self.linked = 0
+        self.converted = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.futures = []
+        # staged filenames used by the exam
+        self.used = set()
+        # staged filenames written (or checked) in this run
+        self.fresh = set()
+
+    def source_key(self, filename):
+        """Source name of a staged "<test>_<year>_<question>_<name>.png" file."""
+        if filename.startswith(self.prefix):
+            question_number, _, name = filename[len(self.prefix):].partition('_')
+            if question_number.isdigit() and name:
+                return name
+        return filename
+
+    def stage(self, filename, question_number):
+        name, ext = os.path.splitext(filename)
+        source_path = os.path.join(self.images_dir, filename)
+        # without its source a staged file can only be reused
+        stat = os.stat(source_path) if os.path.exists(source_path) else None
+        source = [filename, stat.st_size, stat.st_mtime_ns] if stat else None
+        staged_filename = self.staged.get(f"{name}.png")
+        if staged_filename is not None and (staged_filename in self.fresh or source is None or self.sources.get(staged_filename) == source):
+            self.reused += 1
+            self.used.add(staged_filename)
+            self.fresh.add(staged_filename)
+            return staged_filename
+        # a file whose source changed since it was staged is staged again under the same name
+        if staged_filename is None:
+            if ext.lower() == '.jpg' or (ext.lower() == '.png' and not name.startswith(self.prefix)):
+                staged_filename = f"{self.prefix}{question_number}_{name}.png"
+            elif ext.lower() == '.png':
+                staged_filename = filename
+            else:
+                raise ValueError("Unsupported file extension. Only .png and .jpg are allowed.")
+        self.staged[f"{name}.png"] = staged_filename
+        self.used.add(staged_filename)
+        self.fresh.add(staged_filename)
+        self.sources[staged_filename] = source
+        self.futures.append(self.executor.submit(
+            self.copy_image, source_path, os.path.join(self.new_images_dir, staged_filename)
+        ))
+        return staged_filename
+
+    def copy_image(self, source_path, target_path):
+        with open(source_path, 'rb') as source_file:
+            data = source_file.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            twin = self.by_hash.get(content_hash)
+            if twin is None:
+                self.by_hash[content_hash] = done = Future()
+        if twin is not None:
+            link_or_copy(twin.result(), target_path)
+            with self.lock:
+                self.linked += 1
+            return
+        try:
+            if data.startswith(PNG_SIGNATURE):
+                link_or_copy(source_path, target_path)
+            else:
+                # written next to the target first so an interrupted run never leaves a truncated image
+                from PIL import Image
+                tmp_path = f'{target_path}.tmp'
+                Image.open(io.BytesIO(data)).save(tmp_path, format='PNG')
+                os.replace(tmp_path, target_path)
+        except BaseException as error:
+            done.set_exception(error)
+            raise
+        done.set_result(target_path)
+        with self.lock:
+            if data.startswith(PNG_SIGNATURE):
+                self.linked += 1
+            else:
+                self.converted += 1
+
+    def wait(self):
+        """Blocks until every staged image is written, raising the first error, and saves their sources."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        tmp_path = f'{self.sources_path}.tmp'
+        with open(tmp_path, 'w') as sources_file:
+            json.dump(self.sources, sources_file)
+        os.replace(tmp_path, self.sources_path)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+def link_or_copy(source_path, target_path):
+    tmp_path = f'{target_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+# formats accepted by Gemini for the downscaled copies sent for classification
+DERIVATIVE_EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+
+class ImagePreprocessor:
+    """
+    Builds the bounded-resolution, recompressed copies of the staged images that are
+    sent to Gemini for classification. Copies are cached in <year>/new_images_gemini
+    with the mtime of their staged image and rebuilt when it differs (a restaged image
+    hardlinked from its source may be older than the copy), new_images itself is never changed.
+    """
+    def __init__(self, max_edge=1536, image_format='webp', quality=80, colors=0):
+        if image_format not in DERIVATIVE_EXTENSIONS:
+            raise ValueError(f"Unsupported image format {image_format!r}, use one of {list(DERIVATIVE_EXTENSIONS)}")
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+        self.colors = colors
+        # the settings are part of the file name, so changing them never reuses a stale copy
+        self.tag = f"{max_edge}px_q{quality}" + (f"_c{colors}" if colors and image_format == 'png' else '')
+
+    def derivative_path(self, image_path):
+        images_dir, filename = os.path.split(image_path)
+        derivatives_dir = os.path.join(os.path.dirname(images_dir), 'new_images_gemini')
+        return os.path.join(derivatives_dir, f"{os.path.splitext(filename)[0]}.{self.tag}.{DERIVATIVE_EXTENSIONS[self.image_format]}")
+
+    def prepare(self, image_path):
+        target_path = self.derivative_path(image_path)
+        image_mtime = os.stat(image_path).st_mtime_ns
+        if os.path.exists(target_path) and os.stat(target_path).st_mtime_ns == image_mtime:
+            return target_path
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        from PIL import Image
+        with Image.open(image_path) as image:
+            image.thumbnail((self.max_edge, self.max_edge))
+            if self.image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+                # JPEG has no alpha channel, transparent areas become white
+                background = Image.new('RGB', image.size, 'white')
+                rgba = image.convert('RGBA')
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                image = background
+            elif self.image_format == 'png' and self.colors:
+                image = image.convert('RGB').quantize(self.colors)
+            tmp_path = f'{target_path}.tmp'
+            image.save(tmp_path, format=self.image_format.upper(), quality=self.quality, optimize=True)
+        os.utime(tmp_path, ns=(image_mtime, image_mtime))
+        os.replace(tmp_path, target_path)
+        return target_path
+
+    def prepare_all(self, image_paths, max_workers=1):
+        """{image_path: derivative path} for every image in `image_paths`."""
+        image_paths = list(dict.fromkeys(image_paths))
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            return dict(zip(image_paths, executor.map(self.prepare, image_paths)))
@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+import argparse
+from utils import *
+
+# ! =============== VALIDATION RULES ===============
+
+# each rule receives the segmented exam, one question and the parsed gabarito and
+# returns None or (position in the normalized exam, message)
+
+ALTERNATIVE_TEXT_AND_IMAGE_PATTERN = re.compile(r'(?<!\\)\b\w+.*?\\includegraphics.*?\}', re.DOTALL)
+
+def find_table(exam, question, gabarito):
+    """LaTeX tables should be replaced by images."""
+    if question.tables:
+        return question.tables[0], 'LaTeX table, replace it with an image'
+
+def find_extra_image(exam, question, gabarito):
+    first_alternative = question.first_alternative('A')
+    stem_end = question.end if first_alternative is None else first_alternative
+    images = [position for position in question.images if position < stem_end]
+    if len(images) > 1:
+        return images[1], f'{len(images)} images in the question text, only one is supported'
+
+def find_alternative_text_and_image(exam, question, gabarito):
+    # alternative (A): from the last "(A)" up to the next "(B)"
+    last_a = [position for letter, position in question.alternatives if letter == 'A']
+    start = last_a[-1] + 3 if last_a else question.start
+    end = next((position for letter, position in question.alternatives if letter == 'B' and position >= start), question.end)
+    match = ALTERNATIVE_TEXT_AND_IMAGE_PATTERN.search(exam.document, start, end)
+    if match:
+        return match.start(), 'both text and image in the alternatives'
+
+def find_missing_alternative(exam, question, gabarito):
+    letters = {letter for letter, _ in question.alternatives}
+    missing = [letter for letter in ALTERNATIVE_DICT if letter not in letters]
+    if missing:
+        return question.start, f"missing alternative(s) {', '.join(f'({letter})' for letter in missing)}"
+
+def find_invalid_answer(exam, question, gabarito):
+    answer = gabarito.get(question.number)
+    if answer not in ALTERNATIVE_DICT:
+        return question.start, f'answer {answer!r} in gabarito.tex is not one of A-E'
+
+def find_support_text(exam, question, gabarito):
+    # anything written after the line of alternative (E)
+    position = question.first_alternative('E')
+    line_end = exam.document.find('\n', position, question.end) if position is not None else -1
+    match = NON_BLANK_PATTERN.search(exam.document, line_end + 1, question.end) if line_end != -1 else None
+    if match:
+        return match.start(), "text after alternative (E), if it is support text for the next questions make sure it starts with 'Leia'"
+
+# (name, severity, rule), errors stop the exam from being parsed, warnings are only reported
+VALIDATION_RULES = [
+    ('table', 'error', find_table),
+    ('multiple_images', 'error', find_extra_image),
+    ('alternative_text_and_image', 'error', find_alternative_text_and_image),
+    ('missing_alternative', 'error', find_missing_alternative),
+    ('invalid_answer', 'error', find_invalid_answer),
+    ('support_text', 'warning', find_support_text),
+]
+# bump whenever a rule changes, so questions cached by lint.py are checked again
+RULES_VERSION = 1
+
+# ! =============== VALIDATION ENGINE ===============
+
+def make_issue(year, question, rule, severity, line, message):
+    return {'year': year, 'question': question, 'rule': rule, 'severity': severity, 'line': line, 'message': message}
+
+def question_key(exam, question, gabarito):
+    """Hash of everything the rules look at for one question: its text, number and answer."""
+    digest = hashlib.sha256(f'{RULES_VERSION}\0{question.number}\0{gabarito.get(question.number)}\0'.encode('utf-8'))
+    digest.update(exam.document[question.start:question.end].encode('utf-8'))
+    return digest.hexdigest()
+
+def check_question(exam, question, gabarito):
+    """[rule, severity, line relative to the question start, message] of the problems of one question."""
+    problems = []
+    for name, severity, rule in VALIDATION_RULES:
+        problem = rule(exam, question, gabarito)
+        if problem is not None:
+            position, message = problem
+            problems.append([name, severity, exam.document.count('\n', question.start, position), message])
+    return problems
+
+def validate_exam(exam, gabarito, year=None, expected_questions=90, cache=None, used=None):
+    """
+    Runs every rule on every question of a segmented exam in a single pass and
+    returns all the problems found, with their line in the original prova.tex.
+    With a `cache` dict the results are kept by question hash and only questions
+    that changed are checked again. The hashes looked up are added to the `used` set,
+    so callers can drop the stale ones.
+    """
+    issues = []
+    if len(exam.questions) != expected_questions:
+        issues.append(make_issue(year, None, 'question_count', 'error', None,
+                                 f'expected {expected_questions} questions, found {len(exam.questions)}'))
+    if year is not None and year not in SOURCE_DICT:
+        issues.append(make_issue(year, None, 'source', 'error', None, f'year {year} is missing from SOURCE_DICT'))
+    for question in exam.questions:
+        if cache is None:
+            problems = check_question(exam, question, gabarito)
+        else:
+            key = question_key(exam, question, gabarito)
+            if key not in cache:
+                cache[key] = check_question(exam, question, gabarito)
+            problems = cache[key]
+            if used is not None:
+                used.add(key)
+        first_line = exam.line(question.start)
+        for name, severity, line, message in problems:
+            issues.append(make_issue(year, question.number, name, severity, first_line + line, message))
+    return issues
+
+def validate_year(year_path, year, cache=None, used=None):
+    """Validates the prova.tex and gabarito.tex of one exam year."""
+    with open(os.path.join(year_path, 'prova.tex'), 'r') as prova_file:
+        prova_content = prova_file.read()
+    with open(os.path.join(year_path, 'gabarito.tex'), 'r') as gabarito_file:
+        gabarito_content = gabarito_file.read()
+    try:
+        gabarito = parse_gabarito(gabarito_content)
+    except (IndexError, ValueError) as error:
+        return [make_issue(year, None, 'gabarito_format', 'error', None, f'gabarito.tex could not be parsed: {error!r}')]
+    return validate_exam(ExamSegments(*exam_body(prova_content)), gabarito, year, cache=cache, used=used)
+
+def has_errors(issues):
+    return any(issue['severity'] == 'error' for issue in issues)
+
+def print_issues(issues):
+    for issue in issues:
+        location = f"question {issue['question']}" if issue['question'] is not None else 'exam'
+        if issue['line'] is not None:
+            location += f" (prova.tex line {issue['line']})"
+        label = 'Error' if issue['severity'] == 'error' else 'Warning'
+        print(f"{label}: {issue['year']} {location}: {issue['message']}")
+
+def print_validation_summary(issues, years):
+    print_issues(issues)
+    errors = sum(issue['severity'] == 'error' for issue in issues)
+    failed_years = sorted({str(issue['year']) for issue in issues if issue['severity'] == 'error'})
+    print(f"Validated {len(years)} year(s): {errors} error(s), {len(issues) - errors} warning(s)")
+    if failed_years:
+        print(f"Years that need to be fixed: {failed_years}")
+
+def save_validation_report(issues, years, path):
+    report = {
+        'years': [str(year) for year in years],
+        'errors': sum(issue['severity'] == 'error' for issue in issues),
+        'warnings': sum(issue['severity'] == 'warning' for issue in issues),
+        'issues': issues,
+    }
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=4, ensure_ascii=False)
+
+def validate_years(base_path, years):
+    issues = []
+    for year in years:
+        issues += validate_year(os.path.join(base_path, year), int(year))
+    return issues
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--prova_dir', help='Diretório em que as provas estão armazenadas seguindo a estrutura de pastas presente no README.')
+parser.add_argument('--years', nargs='*', help='Anos a serem validados (por padrão, todos os anos em --prova_dir).')
+parser.add_argument('--report', default=None, help='Caminho do relatório JSON (por padrão, validation_report.json dentro de --prova_dir).')
+
+def main() -> None:
+    args = parser.parse_args()
+    base_path = f'./{args.prova_dir}'
+    years = args.years or list_exam_years(base_path)
+    issues = validate_years(base_path, years)
+    print_validation_summary(issues, years)
+    save_validation_report(issues, years, args.report or os.path.join(base_path, 'validation_report.json'))
+    if has_errors(issues):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()